@@ -0,0 +1,228 @@
+"""
+Throughput and regression benchmark of heti on the pages of corpus.py.
+
+For every engine and page it measures the time (best of --repeat runs), how
+much typesetting raises the peak RSS of a fresh process holding the page
+(libxml2's memory included, which tracemalloc does not see; not measured on
+Windows) and, for the soup engine, the time of each rule of
+Heti.spacingElement, and the size of the output with and without compact:
+true. Every output is checked against golden.json: the soup engine byte for
+byte, the other engines after being parsed and serialized again by
+BeautifulSoup, and the run fails when one differs. Results go to JSON:
+
+    python benchmarks/bench_heti.py --output results.json
+    python benchmarks/bench_heti.py --compare results.json  # fail on regressions
+    python benchmarks/bench_heti.py --update-golden         # after a wanted change
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from bs4 import BeautifulSoup
+
+from corpus import corpus
+from mkdocs_heti_plugin import __version__
+from mkdocs_heti_plugin.utils.heti import HETI_ENGINES, Heti, heti
+from mkdocs_heti_plugin.utils.profile import maxRss
+
+GOLDEN_PATH = os.path.join(BENCHMARKS_DIR, "golden.json")
+ROOT_SELECTOR = "article"
+
+
+def digest(html):
+    return hashlib.sha256(html.encode("utf-8")).hexdigest()
+
+
+def normalize(html):
+    # the engines serialize the markup they do not change differently, e.g.
+    # lxml writes checked="checked" as checked
+    soup = BeautifulSoup(html, "lxml")
+    for tag in soup.find_all(True):
+        for name, value in tag.attrs.items():
+            if value == name:
+                tag[name] = ""
+    return str(soup)
+
+
+def run(html, engine):
+    start = time.perf_counter()
+    output = heti(html, ROOT_SELECTOR, engine=engine)
+    return output, time.perf_counter() - start
+
+
+def run_steps(html):
+    # the time of each rule, searching and replacing, over all the roots
+    profile = {}
+    Heti(html, ROOT_SELECTOR, profile=profile).spacing()
+    return [step["search"] + step["replace"] for step in profile["steps"]]
+
+
+def peak_memory(html, engine):
+    # in bytes, by a process of its own so that the pages and engines before
+    # do not count, see measure_rss
+    if maxRss() is None:
+        return None
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--measure-rss", engine],
+        input=html.encode("utf-8"), stdout=subprocess.PIPE, check=True,
+    )
+    return int(result.stdout) * 1024
+
+
+def peak_rss():
+    # in KB; on Linux ru_maxrss starts at the peak of the parent process,
+    # carried over by fork and exec, VmHWM is the process' own
+    try:
+        with open("/proc/self/status", encoding="ascii") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return maxRss()
+
+
+def measure_rss(engine):
+    # run in the process of peak_memory: the page comes from stdin, the
+    # increase of the peak RSS while typesetting it goes to stdout, in KB
+    html = sys.stdin.buffer.read().decode("utf-8")
+    # the modules the engines import on their first page are loaded first
+    heti("<article>中文abc</article>", ROOT_SELECTOR, engine=engine)
+    before = peak_rss()
+    heti(html, ROOT_SELECTOR, engine=engine)
+    print(peak_rss() - before)
+
+
+def benchmark(pages, engines, repeat):
+    golden = {}
+    if os.path.exists(GOLDEN_PATH):
+        with open(GOLDEN_PATH, encoding="utf-8") as file:
+            golden = json.load(file)
+    results = {}
+    for engine in engines:
+        pageResults = {}
+        for name, html in pages.items():
+            times = []
+            for _ in range(repeat):
+                output, elapsed = run(html, engine)
+                times.append(elapsed)
+            result = {
+                "bytes": len(html.encode("utf-8")),
+                "seconds": min(times),
+                "peak_memory": peak_memory(html, engine),
+                "output_bytes": len(output.encode("utf-8")),
+                "compact_bytes": len(heti(html, ROOT_SELECTOR, engine=engine, compact=True).encode("utf-8")),
+            }
+            if engine == "soup":
+                result["steps"] = run_steps(html)
+                result["golden"] = golden.get(name, {}).get("raw") == digest(output)
+            else:
+                result["golden"] = golden.get(name, {}).get("normalized") == digest(normalize(output))
+            pageResults[name] = result
+            memory = "-" if result["peak_memory"] is None else f"{result['peak_memory'] / 1024 / 1024:.1f}"
+            print(
+                f"{engine:<8}{name:<24}{result['seconds'] * 1000:>10.1f} ms"
+                f"{memory:>10} MB RSS"
+                f"{result['output_bytes'] / 1024:>10.1f} KB"
+                f"{result['compact_bytes'] / 1024:>10.1f} KB compact"
+                f"{'' if result['golden'] else '  output differs from golden'}"
+            )
+        seconds = sum(result["seconds"] for result in pageResults.values())
+        size = sum(result["bytes"] for result in pageResults.values())
+        results[engine] = {
+            "pages_per_second": len(pageResults) / seconds,
+            "bytes_per_second": size / seconds,
+            "pages": pageResults,
+        }
+        output = sum(result["output_bytes"] for result in pageResults.values())
+        compact = sum(result["compact_bytes"] for result in pageResults.values())
+        print(
+            f"{engine:<8}{len(pageResults) / seconds:.2f} pages/s, {size / seconds / 1024:.0f} KB/s, "
+            f"input {size / 1024:.0f} KB, output {output / 1024:.0f} KB, {compact / 1024:.0f} KB compact "
+            f"({(output - compact) / (output - size) * 100:.0f}% less markup added)"
+        )
+    return results
+
+
+def update_golden(pages):
+    golden = {}
+    for name, html in pages.items():
+        output = heti(html, ROOT_SELECTOR, engine="soup")
+        golden[name] = {"raw": digest(output), "normalized": digest(normalize(output))}
+    with open(GOLDEN_PATH, "w", encoding="utf-8") as file:
+        json.dump(golden, file, indent=2, sort_keys=True)
+        file.write("\n")
+    print(f"wrote {GOLDEN_PATH}")
+
+
+def compare(results, baselinePath, threshold):
+    # pages slower than the baseline by more than the threshold, or whose
+    # output does not match the golden anymore
+    with open(baselinePath, encoding="utf-8") as file:
+        baseline = json.load(file)["results"]
+    failures = []
+    for engine, engineResults in results.items():
+        for name, result in engineResults["pages"].items():
+            if not result["golden"]:
+                failures.append(f"{engine} {name}: output differs from golden")
+            old = baseline.get(engine, {}).get("pages", {}).get(name)
+            if old and result["seconds"] > old["seconds"] * threshold:
+                failures.append(f"{engine} {name}: {old['seconds'] * 1000:.1f} ms -> {result['seconds'] * 1000:.1f} ms")
+    for failure in failures:
+        print(failure)
+    return not failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", nargs="+", choices=HETI_ENGINES, default=HETI_ENGINES)
+    parser.add_argument("--page", nargs="+", help="only these pages of the corpus")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="results of a previous run to check for regressions")
+    parser.add_argument("--threshold", type=float, default=1.2, help="slowdown allowed by --compare")
+    parser.add_argument("--update-golden", action="store_true")
+    parser.add_argument("--measure-rss", choices=HETI_ENGINES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure_rss:
+        measure_rss(args.measure_rss)
+        return
+
+    pages = corpus()
+    if args.page:
+        pages = {name: pages[name] for name in args.page}
+    if args.update_golden:
+        update_golden(pages)
+        return
+
+    results = benchmark(pages, args.engine, args.repeat)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump({
+                "version": __version__,
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "results": results,
+            }, file, indent=2)
+    if args.compare:
+        if not compare(results, args.compare, args.threshold):
+            sys.exit(1)
+    elif not all(result["golden"] for engineResults in results.values() for result in engineResults["pages"].values()):
+        # compare reports them itself
+        print("output differs from golden, see above; --update-golden if the change is wanted")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
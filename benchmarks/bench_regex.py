@@ -0,0 +1,79 @@
+"""
+Micro-benchmark of the six heti rules on long pathological paragraphs.
+
+Compares the current search-based patterns with the previous ones, which had
+a leading .*? and were matched from every start position. The legacy
+CJK_START alone takes over a minute on the latin text, it is quadratic there:
+
+    python benchmarks/bench_regex.py
+"""
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mkdocs_heti_plugin.utils import heti as H
+
+LEGACY = {
+    "CJK_FULL": rf".*?(?<=[{H.CJK}])( *[{H.ANS}]+(?: +[{H.ANS}]+)* *)(?=[{H.CJK}])",
+    "CJK_START": rf".*?([{H.ANS}]+(?: +[{H.ANS}]+)* *)(?=[{H.CJK}])",
+    "CJK_END": rf".*?(?<=[{H.CJK}])( *[{H.ANS}]+(?: +[{H.ANS}]+)*)",
+    "BD_HALF": ".*?" + H.REG_BD_HALF,
+    "BD_QUARTER": ".*?" + H.REG_BD_QUARTER,
+    "BD_QUARTER_EXTRA": ".*?" + H.REG_BD_QUARTER_EXTRA,
+}
+
+SIZE = 50 * 1024
+
+TEXTS = {
+    "chinese without latin": ("中文排版测试，汉字标点。" * SIZE)[:SIZE],
+    "latin without chinese": ("lorem ipsum dolor sit amet " * SIZE)[:SIZE],
+    "mixed": ("中文English混排，“引号”（括号）。" * SIZE)[:SIZE],
+}
+
+
+def legacy_matches(regex, text):
+    count = 0
+    pos = 0
+    while match := regex.match(text, pos):
+        count += 1
+        pos = match.end()
+    return count
+
+
+def search_matches(regex, text):
+    count = 0
+    pos = 0
+    while match := regex.search(text, pos):
+        count += 1
+        pos = match.end()
+    return count
+
+
+def measure(func, regex, text, budget=2.0):
+    start = time.perf_counter()
+    count = func(regex, text)
+    elapsed = time.perf_counter() - start
+    if elapsed > budget:
+        return count, elapsed
+    runs = max(1, int(budget / max(elapsed, 1e-6) / 10))
+    start = time.perf_counter()
+    for _ in range(runs):
+        func(regex, text)
+    return count, (time.perf_counter() - start) / runs
+
+
+def main():
+    print(f"{'text':<24}{'rule':<18}{'matches':>8}{'legacy ms':>12}{'search ms':>12}")
+    for textName, text in TEXTS.items():
+        for rule, legacy in LEGACY.items():
+            current = getattr(H, f"COMPILED_REG_{rule}")
+            count, legacyTime = measure(legacy_matches, re.compile(legacy), text)
+            _, searchTime = measure(search_matches, current, text)
+            print(f"{textName:<24}{rule:<18}{count:>8}{legacyTime * 1000:>12.2f}{searchTime * 1000:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
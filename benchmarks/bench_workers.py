@@ -0,0 +1,74 @@
+"""
+Scaling of heti_batch with the number of workers, for the process and the
+thread pools, on the pages of corpus.py typeset --copies times each.
+
+Threads only typeset in parallel on a free-threaded Python (3.13t and later,
+or PYTHON_GIL=0), with the GIL they are about as fast as a single worker.
+Every output is checked against the one of a single worker:
+
+    python3.13t benchmarks/bench_workers.py --workers 1 2 4 8
+"""
+import argparse
+import os
+import platform
+import sys
+import sysconfig
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from corpus import corpus
+from mkdocs_heti_plugin.batch import heti_batch
+from mkdocs_heti_plugin.utils.pool import HETI_EXECUTORS
+
+ROOT_SELECTOR = "article"
+
+
+def gil_enabled():
+    # sys._is_gil_enabled is new in 3.13, the GIL can be enabled again at run
+    # time on a free-threaded build
+    if hasattr(sys, "_is_gil_enabled"):
+        return sys._is_gil_enabled()
+    return True
+
+
+def run(documents, executor, workers):
+    start = time.perf_counter()
+    outputs = list(heti_batch(documents, ROOT_SELECTOR, workers=workers, executor=executor))
+    return outputs, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--executor", nargs="+", choices=HETI_EXECUTORS, default=HETI_EXECUTORS)
+    parser.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4])
+    parser.add_argument("--copies", type=int, default=4, help="times each page of the corpus is typeset")
+    args = parser.parse_args()
+
+    documents = list(corpus().values()) * args.copies
+    size = sum(len(document.encode("utf-8")) for document in documents)
+    print(
+        f"python {platform.python_version()}, "
+        f"free-threaded build: {bool(sysconfig.get_config_var('Py_GIL_DISABLED'))}, "
+        f"GIL enabled: {gil_enabled()}, {os.cpu_count()} CPU(s)"
+    )
+    print(f"{len(documents)} pages, {size / 1024 / 1024:.1f} MB")
+
+    expected, seconds = run(documents, "process", 1)
+    print(f"{'single':<10}{1:>4} worker(s){seconds:>10.2f} s{len(documents) / seconds:>10.1f} pages/s")
+    for executor in args.executor:
+        for workers in args.workers:
+            if workers <= 1:
+                continue
+            outputs, elapsed = run(documents, executor, workers)
+            print(
+                f"{executor:<10}{workers:>4} worker(s){elapsed:>10.2f} s{len(documents) / elapsed:>10.1f} pages/s"
+                f"{seconds / elapsed:>8.2f}x"
+                f"{'' if outputs == expected else '  output differs from a single worker'}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+Pages for the benchmarks: hand-written MkDocs Material pages in fixtures/ and
+synthetic pages of mixed Chinese and latin text, generated from a seed.
+"""
+import os
+import random
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+CJK = "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处理府研"
+LATIN = [
+    "MkDocs", "Material", "Python", "HTML", "CSS", "JavaScript", "API", "URL", "JSON", "YAML",
+    "GitHub", "Linux", "macOS", "Windows", "pip", "npm", "HTTP/2", "v1.2.3", "2023", "100%",
+    "C++", "x86_64", "UTF-8", "README.md", "foo_bar", "O(n)", "i18n", "e.g.", "TCP/IP", "Unicode",
+]
+PUNCTUATION = "。，、：；！？「」『』（）《》“”‘’·【】〔〕"
+STOPS = "。，、；！？"
+OPEN_CLOSE = ["「」", "『』", "（）", "《》", "“”", "‘’", "【】"]
+MATH = [r"\(x^2 + y^2 = z^2\)", r"\(O(n \log n)\)", r"\(\sum_{i=1}^n i\)", r"\(a_1, a_2, \dots\)"]
+KEYS = ["Ctrl", "Alt", "Shift", "Enter", "Tab", "Esc", "Cmd"]
+INLINE = ["a", "em", "strong", "code", "span", "b", "i", "mark", "del"]
+
+TEMPLATE = """<!doctype html>
+<html lang="zh" class="no-js">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width,initial-scale=1">
+<title>{title} - 笔记本 Notebook</title>
+<link rel="stylesheet" href="../assets/stylesheets/main.css">
+<link rel="stylesheet" href="../css/heti.css">
+</head>
+<body dir="ltr" data-md-color-scheme="default">
+<header class="md-header" data-md-component="header">
+<nav class="md-header__inner md-grid" aria-label="页眉">
+<a href=".." title="笔记本 Notebook" class="md-header__button md-logo">笔记本</a>
+<div class="md-header__title"><span class="md-ellipsis">{title}</span></div>
+</nav>
+</header>
+<div class="md-container" data-md-component="container">
+<main class="md-main" data-md-component="main">
+<div class="md-main__inner md-grid">
+<div class="md-sidebar md-sidebar--primary" data-md-component="sidebar" data-md-type="navigation">
+<nav class="md-nav md-nav--primary" aria-label="导航栏">
+<ul class="md-nav__list">
+<li class="md-nav__item"><a href=".." class="md-nav__link">首页 Home</a></li>
+<li class="md-nav__item md-nav__item--active"><a href="./" class="md-nav__link">{title}</a></li>
+</ul>
+</nav>
+</div>
+<div class="md-content" data-md-component="content">
+<article class="md-content__inner md-typeset">
+<h1 id="title">{title}</h1>
+{body}
+</article>
+</div>
+</div>
+</main>
+<footer class="md-footer">
+<div class="md-footer-meta md-typeset">
+<div class="md-copyright">Copyright &copy; 2023 笔记本 Made with <a href="https://squidfunk.github.io/mkdocs-material/">Material for MkDocs</a></div>
+</div>
+</footer>
+</div>
+<script src="../assets/javascripts/bundle.js"></script>
+</body>
+</html>
+"""
+
+
+def escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+class Generator:
+    def __init__(self, seed, punctuation, protected, depth):
+        self.random = random.Random(seed)
+        self.punctuation = punctuation
+        self.protected = protected
+        self.depth = depth
+
+    def chinese(self):
+        return "".join(self.random.choice(CJK) for _ in range(self.random.randint(2, 12)))
+
+    def text(self, words):
+        r = self.random
+        out = []
+        for _ in range(words):
+            k = r.random()
+            if k < self.punctuation:
+                if r.random() < 0.5:
+                    out.append(r.choice(STOPS))
+                else:
+                    pair = r.choice(OPEN_CLOSE)
+                    out.append(pair[0] + self.chinese() + pair[1])
+                    if r.random() < 0.3:
+                        out.append(r.choice(STOPS))
+            elif k < self.punctuation + (1 - self.punctuation) * 0.3:
+                word = r.choice(LATIN)
+                out.append(f" {word} " if r.random() < 0.3 else word)
+            else:
+                out.append(self.chinese())
+        return escape("".join(out))
+
+    def inline(self, depth, link=False):
+        r = self.random
+        parts = []
+        for _ in range(r.randint(2, 8)):
+            k = r.random()
+            if k < self.protected:
+                if r.random() < 0.5:
+                    parts.append("<kbd>" + "</kbd>+<kbd>".join(r.sample(KEYS, 2)) + "</kbd>")
+                else:
+                    parts.append(f'<span class="arithmatex">{escape(r.choice(MATH))}</span>')
+            elif k < 0.3 and depth < self.depth:
+                # links are never nested, HTML does not allow it
+                tag = r.choice(INLINE[1:] if link else INLINE)
+                attrs = ' href="#"' if tag == "a" else ""
+                parts.append(f"<{tag}{attrs}>{self.inline(depth + 1, link or tag == 'a')}</{tag}>")
+            else:
+                parts.append(self.text(r.randint(2, 10)))
+        return "".join(parts)
+
+    def block(self, depth):
+        r = self.random
+        k = r.random()
+        if depth < self.depth and k < 0.1:
+            inner = "".join(self.block(depth + 1) for _ in range(r.randint(1, 3)))
+            return f'<div class="admonition note">\n<p class="admonition-title">{self.text(2)}</p>\n{inner}</div>\n'
+        if depth < self.depth and k < 0.15:
+            return f"<blockquote>\n{self.block(depth + 1)}</blockquote>\n"
+        if k < 0.25:
+            items = "".join(f"<li>{self.inline(depth)}</li>\n" for _ in range(r.randint(2, 5)))
+            return f"<ul>\n{items}</ul>\n"
+        if k < 0.3:
+            rows = "".join(
+                "<tr>" + "".join(f"<td>{self.inline(depth)}</td>" for _ in range(3)) + "</tr>\n"
+                for _ in range(r.randint(2, 6))
+            )
+            return f"<table>\n<thead><tr><th>{self.text(2)}</th><th>{self.text(2)}</th><th>{self.text(2)}</th></tr></thead>\n<tbody>\n{rows}</tbody>\n</table>\n"
+        if k < 0.35:
+            code = escape("\n".join(f"print(\"{self.chinese()}\")  # {r.choice(LATIN)}" for _ in range(r.randint(2, 8))))
+            return f'<div class="highlight"><pre><span></span><code>{code}\n</code></pre></div>\n'
+        if k < 0.4:
+            return f'<h2 id="section-{r.randint(0, 10 ** 6)}">{self.text(4)}</h2>\n'
+        return f"<p>{self.inline(depth)}</p>\n"
+
+
+def synthetic_page(seed=0, size=20000, punctuation=0.15, protected=0.05, depth=2):
+    """
+    A Material page with about `size` characters of article: `punctuation` is
+    the share of words that are punctuation, `protected` the share of inline
+    parts in kbd or arithmatex, `depth` the nesting depth of the blocks and of
+    the inline elements.
+    """
+    generator = Generator(seed, punctuation, protected, depth)
+    blocks = []
+    length = 0
+    while length < size:
+        block = generator.block(0)
+        blocks.append(block)
+        length += len(block)
+    return TEMPLATE.format(title=generator.chinese(), body="".join(blocks))
+
+
+def fixture_pages():
+    pages = {}
+    for name in sorted(os.listdir(FIXTURES_DIR)):
+        if name.endswith(".html"):
+            with open(os.path.join(FIXTURES_DIR, name), encoding="utf-8") as file:
+                pages[name[:-len(".html")]] = file.read()
+    return pages
+
+
+SYNTHETIC = {
+    "synthetic-small": dict(seed=1, size=20000),
+    "synthetic-large": dict(seed=2, size=200000),
+    "synthetic-punctuation": dict(seed=3, size=50000, punctuation=0.5),
+    "synthetic-protected": dict(seed=4, size=50000, protected=0.3),
+    "synthetic-deep": dict(seed=5, size=50000, depth=6),
+}
+
+
+def corpus():
+    pages = fixture_pages()
+    for name, options in SYNTHETIC.items():
+        pages[name] = synthetic_page(**options)
+    return pages
+
+
+if __name__ == "__main__":
+    import sys
+    print(synthetic_page(*(int(arg) for arg in sys.argv[1:2])))
@@ -0,0 +1,190 @@
+"""
+heti outside of MkDocs, for HTML exported by other tools:
+
+    python -m mkdocs_heti_plugin site/ out/ --root-selector body --workers 8
+
+or from Python, with heti_batch which typesets an iterable of documents and
+yields the results in the same order.
+"""
+import argparse
+import fnmatch
+import os
+import sys
+import time
+from collections import deque
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from .utils.pool import HETI_EXECUTORS, HetiOptions, heti_page, heti_page_worker, worker_pool
+from .utils.finder import MatchMemo
+from .utils.heti import HETI_ENGINES, HETI_PROTECTED_SELECTORS, HetiElements
+
+def heti_batch(
+    documents: Iterable[str],
+    root_selector: str = "article",
+    protected_selectors: Optional[List[str]] = None,
+    protected_patterns: Optional[List[Tuple[str, str]]] = None,
+    engine: str = "soup",
+    elements: Optional[HetiElements] = None,
+    workers: int = 1,
+    stats: Optional[dict] = None,
+    fragment: bool = False,
+    memo_size: int = 10000,
+    compact: bool = False,
+    large_page_size: int = 0,
+    executor: str = "process",
+) -> Iterator[str]:
+    """
+    Typeset every document of `documents` like the plugin does for a page.
+    The documents are read as the results are consumed: with `workers` > 1
+    they are typeset by a pool of processes, or of threads with `executor`
+    "thread" on a free-threaded Python, with at most a few documents per
+    worker waiting, so any number of documents can go through in bounded
+    memory.
+
+    With `fragment` the documents are fragments of HTML, typeset as a whole
+    instead of in their `root_selector`. With `compact` the western text gets
+    a single span with margins instead of spans of spaces. The documents
+    longer than `large_page_size` characters are typeset a block at a time,
+    0 disables it. Each worker keeps the matches of up to `memo_size` texts
+    for the documents after. `stats` gets the number of documents, their
+    size in bytes, the time spent and the hits and misses of the match memo
+    when given.
+
+    Raises ValueError right away for a wrong protected pattern, the
+    patterns are compiled once for all the documents.
+    """
+    options = HetiOptions(
+        root_selector=root_selector,
+        protected_selectors=protected_selectors,
+        protected_patterns=protected_patterns,
+        engine=engine,
+        elements=elements,
+        fragment=fragment,
+        compact=compact,
+        large_page_size=large_page_size,
+    )
+    return _heti_batch(documents, options, workers, stats, memo_size, executor)
+
+def _heti_batch(
+    documents: Iterable[str],
+    options: HetiOptions,
+    workers: int,
+    stats: Optional[dict],
+    memo_size: int,
+    executor: str,
+) -> Iterator[str]:
+    if stats is not None:
+        stats.update(documents=0, bytes=0, seconds=0.0, memo_hits=0, memo_misses=0)
+    start = time.perf_counter()
+
+    def done(document: str, hits: int, misses: int) -> None:
+        if stats is not None:
+            stats["documents"] += 1
+            stats["bytes"] += len(document.encode("utf-8"))
+            stats["seconds"] = time.perf_counter() - start
+            stats["memo_hits"] += hits
+            stats["memo_misses"] += misses
+
+    if workers <= 1:
+        memo = MatchMemo(memo_size) if memo_size > 0 else None
+        for document in documents:
+            hits, misses = (memo.hits, memo.misses) if memo else (0, 0)
+            html = heti_page(document, options, memo=memo)
+            if memo:
+                hits, misses = memo.hits - hits, memo.misses - misses
+            done(document, hits, misses)
+            yield html
+        return
+
+    with worker_pool(executor, workers, memo_size) as pool:
+        # documents being typeset, oldest first
+        running = deque()
+        for document in documents:
+            running.append((document, pool.submit(heti_page_worker, document, options)))
+            if len(running) >= workers * 4:
+                document, future = running.popleft()
+                html, _, hits, misses = future.result()
+                done(document, hits, misses)
+                yield html
+        while running:
+            document, future = running.popleft()
+            html, _, hits, misses = future.result()
+            done(document, hits, misses)
+            yield html
+
+def find_documents(in_dir: str, patterns: List[str]) -> Iterator[str]:
+    # paths relative to in_dir, in a stable order
+    for root, dirs, files in os.walk(in_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                yield os.path.relpath(os.path.join(root, name), in_dir)
+
+def read_documents(in_dir: str, paths: Iterable[str]) -> Iterator[str]:
+    for path in paths:
+        with open(os.path.join(in_dir, path), "r", encoding="utf-8") as file:
+            yield file.read()
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m mkdocs_heti_plugin",
+        description="Typeset the HTML files of a directory with heti.",
+    )
+    parser.add_argument("in_dir")
+    parser.add_argument("out_dir", help="the files are written at the same relative paths, can be in_dir")
+    parser.add_argument("--pattern", nargs="+", default=["*.html", "*.htm"], help="names of the files to typeset")
+    parser.add_argument("--root-selector", default="article")
+    parser.add_argument("--fragment", action="store_true", help="the files are fragments of HTML, typeset as a whole")
+    parser.add_argument("--compact", action="store_true", help="one span with margins around western text")
+    parser.add_argument("--large-page-size", type=int, default=0, help="MB, larger files are typeset a block at a time")
+    parser.add_argument("--protected-selectors", nargs="*", default=HETI_PROTECTED_SELECTORS)
+    parser.add_argument("--extra-protected-patterns", nargs="*", default=[])
+    parser.add_argument("--extra-skipped-class", nargs="*", default=[])
+    parser.add_argument("--extra-skipped-elements", nargs="*", default=[])
+    parser.add_argument("--extra-non-contiguous-elements", nargs="*", default=[])
+    parser.add_argument("--engine", choices=HETI_ENGINES, default="soup")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--executor", choices=HETI_EXECUTORS, default="process", help="thread for a free-threaded Python")
+    parser.add_argument("--memo-size", type=int, default=10000, help="texts whose matches are kept, 0 to disable")
+    parser.add_argument("--quiet", action="store_true", help="do not print the files")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.in_dir):
+        parser.error(f"not a directory: {args.in_dir}")
+    # the list of paths is kept, the documents are read one by one
+    paths = list(find_documents(args.in_dir, args.pattern))
+    stats = {}
+    try:
+        results = heti_batch(
+            read_documents(args.in_dir, paths),
+            root_selector=args.root_selector,
+            protected_selectors=args.protected_selectors,
+            protected_patterns=[("extra", pattern) for pattern in args.extra_protected_patterns],
+            engine=args.engine,
+            elements=HetiElements(args.extra_skipped_class, args.extra_skipped_elements, args.extra_non_contiguous_elements),
+            workers=args.workers,
+            stats=stats,
+            fragment=args.fragment,
+            memo_size=args.memo_size,
+            compact=args.compact,
+            large_page_size=args.large_page_size * 1024 * 1024,
+            executor=args.executor,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    for path, html in zip(paths, results):
+        dest = os.path.join(args.out_dir, path)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with open(dest, "w", encoding="utf-8") as file:
+            file.write(html)
+        if not args.quiet:
+            print(path, file=sys.stderr)
+
+    seconds = stats.get("seconds") or 1e-9
+    print(
+        f"heti: typeset {stats['documents']} file(s), {stats['bytes'] / 1024 / 1024:.1f} MB "
+        f"in {seconds:.2f}s ({stats['documents'] / seconds:.1f} files/s, "
+        f"{stats['bytes'] / 1024 / 1024 / seconds:.2f} MB/s)",
+        file=sys.stderr,
+    )
+    print(f"heti: match memo {stats['memo_hits']} hit(s), {stats['memo_misses']} miss(es)", file=sys.stderr)
@@ -1,19 +1,29 @@
+import hashlib
+import logging
 import os
-import re
+import time
+from itertools import repeat
 
 from mkdocs.config import config_options
-from mkdocs.plugins import BasePlugin
+from mkdocs.exceptions import PluginError
+from mkdocs.plugins import BasePlugin, event_priority
+from mkdocs.structure.files import Files
+from mkdocs.structure.nav import Navigation
 from mkdocs.structure.pages import Page
-from mkdocs.utils import copy_file
+from mkdocs.utils import copy_file, write_file
 
-from typing import Any, Dict, Optional, Literal
+from typing import Any, Callable, Dict, Optional, Literal
 
-from .utils.heti import heti
-from .utils.heti import (
-    HETI_NON_CONTIGUOUS_ELEMENTS,
-    HETI_SKIPPED_ELEMENTS,
-    HETI_SKIPPED_CLASS,
-)
+from . import __version__
+from .utils.cache import HETI_OUTPUT_HASH, HetiCache
+from .utils.css import hetiNames, minifyCss, subsetCss
+from .utils.finder import MatchMemo
+from .utils.heti import HETI_ENGINES, HETI_PROTECTED_SELECTORS, HetiElements
+from .utils.pool import HETI_EXECUTORS, HetiOptions, heti_page, heti_page_worker, worker_pool
+from .utils.profile import maxRss, summarize, writeReport
+from .utils.protect import HETI_PROTECTED_PATTERNS
+
+log = logging.getLogger(f"mkdocs.plugins.{__name__}")
 
 PLUGIN_DIR = os.path.dirname(os.path.realpath(__file__))
 HETI_CSS_DIR = os.path.join(PLUGIN_DIR, 'css/heti.css')
@@ -25,18 +35,52 @@ class HetiPlugin(BasePlugin):
     config_scheme = (
         ('enabled', config_options.Type(bool, default=True)),
         ('root_selector', config_options.Type(str, default="article")),
-        ('disable_serve', config_options.Type(bool, default=True)),
+        ('disable_serve', config_options.Type(bool, default=False)),
         ('extra_skipped_class', config_options.Type(list, default=[])),
         ('extra_skipped_elements', config_options.Type(list, default=[])),
         ('extra_non_contiguous_elements', config_options.Type(list, default=[])),
+        ('cache', config_options.Type(bool, default=False)),
+        ('cache_dir', config_options.Type(str, default=".cache/heti")),
+        ('cache_max_size', config_options.Type(int, default=256)),
+        ('workers', config_options.Type(int, default=1)),
+        ('executor', config_options.Choice(HETI_EXECUTORS, default="process")),
+        ('protected_selectors', config_options.Type(list, default=HETI_PROTECTED_SELECTORS)),
+        ('extra_protected_patterns', config_options.Type(list, default=[])),
+        ('engine', config_options.Choice(HETI_ENGINES, default="soup")),
+        ('profile', config_options.Type(bool, default=False)),
+        ('profile_top', config_options.Type(int, default=10)),
+        ('profile_report', config_options.Type(str, default="")),
+        ('fragment', config_options.Type(bool, default=False)),
+        ('search_original', config_options.Type(bool, default=True)),
+        ('match_memo_size', config_options.Type(int, default=10000)),
+        ('css_subset', config_options.Type(bool, default=False)),
+        ('css_hash', config_options.Type(bool, default=False)),
+        ('compact', config_options.Type(bool, default=False)),
+        ('large_page_size', config_options.Type(int, default=0)),
     )
 
     enabled = True
     serve = False
+    dirty = False
+    cache = None
+    pending = []
+    names = set()
+    pages = []
+    options = HetiOptions()
+    # spans of the rules in the texts already seen, kept across the rebuilds
+    # of serve too
+    match_memo = None
+    # page -> (key, html) of the last build and of the current one, kept
+    # across the rebuilds of serve
+    memo = None
+    built = None
 
     def on_startup(self, *, command: Literal['build', 'gh-deploy', 'serve'], dirty: bool) -> None:
+        self.dirty = dirty
         if command == "serve":
             self.serve = True
+            self.memo = {}
+            self.built = {}
 
     def on_config(self, config: config_options.Config, **kwargs) -> Dict[str, Any]:
         if not self.enabled:
@@ -49,11 +93,76 @@ class HetiPlugin(BasePlugin):
             return config
         
         config["extra_css"] = ["css/heti.css"] + config["extra_css"]
-        HETI_SKIPPED_CLASS.extend(self.config.get('extra_skipped_class'))
-        HETI_SKIPPED_ELEMENTS.extend(self.config.get('extra_skipped_elements'))
-        HETI_NON_CONTIGUOUS_ELEMENTS.extend(self.config.get('extra_non_contiguous_elements'))
+        if self.config.get('workers') > 1 and not self.config.get('fragment'):
+            self.check_post_page(config)
+        # built again from the defaults on every load of the config, serve
+        # reloads it on each rebuild
+        try:
+            self.options = HetiOptions(
+                root_selector=self.config.get('root_selector'),
+                protected_selectors=self.config.get('protected_selectors'),
+                protected_patterns=HETI_PROTECTED_PATTERNS + [
+                    ("extra", pattern) for pattern in self.config.get('extra_protected_patterns')
+                ],
+                engine=self.config.get('engine'),
+                elements=HetiElements(
+                    self.config.get('extra_skipped_class'),
+                    self.config.get('extra_skipped_elements'),
+                    self.config.get('extra_non_contiguous_elements'),
+                ),
+                fragment=self.config.get('fragment'),
+                compact=self.config.get('compact'),
+                # large_page_size is in MB, of characters
+                large_page_size=self.config.get('large_page_size') * 1024 * 1024,
+            )
+        except ValueError as e:
+            raise PluginError(f"heti: {e}") from e
+
+        self.cache = None
+        if self.config.get('cache'):
+            cache_dir = self.config.get('cache_dir')
+            if not os.path.isabs(cache_dir):
+                cache_dir = os.path.join(os.path.dirname(config["config_file_path"] or ""), cache_dir)
+            # cache_max_size is in MB
+            self.cache = HetiCache(cache_dir, self.config.get('cache_max_size') * 1024 * 1024)
+        self.pending = []
+        self.typeset = 0
+        self.reused = 0
+        self.typeset_time = 0.0
+        self.profiles = []
+        memo_size = self.config.get('match_memo_size')
+        if memo_size <= 0:
+            self.match_memo = None
+        elif self.match_memo is None or self.match_memo.maxSize != memo_size:
+            self.match_memo = MatchMemo(memo_size)
+        # classes and elements of heti in the pages of this build, for
+        # css_subset, and the pages that link to heti.css, for css_hash
+        self.names = set()
+        self.pages = []
+        # hits and misses of the memos of this build, the workers' included
+        self.memo_hits = 0
+        self.memo_misses = 0
+        if self.memo is not None:
+            self.built = {}
+        return config
     
-    def on_post_page(self, output: str, *, page: Page, config: config_options.Config) -> Optional[str]:
+    def check_post_page(self, config: config_options.Config) -> None:
+        # with workers > 1 the whole pages are typeset and written in
+        # on_post_build from the output heti got in on_post_page, what the
+        # on_post_page of the plugins after heti changes would be lost
+        handlers = config.plugins.events['post_page']
+        later = []
+        for handler in handlers[[handler == self.on_post_page for handler in handlers].index(True) + 1:]:
+            plugin = getattr(handler, '__self__', None)
+            names = [name for name, item in config.plugins.items() if item is plugin]
+            later.append(names[0] if names else getattr(handler, '__module__', repr(handler)))
+        if later:
+            raise PluginError(
+                f"heti: workers > 1 would overwrite the changes of {', '.join(later)} in on_post_page, "
+                f"list heti after them in plugins, or use fragment: true or workers: 1"
+            )
+
+    def on_page_content(self, html: str, *, page: Page, config: config_options.Config, files: Files) -> Optional[str]:
         if not self.enabled:
             return
         
@@ -62,33 +171,165 @@ class HetiPlugin(BasePlugin):
 
         if self.config.get('disable_serve') and self.serve:
             return
+
+        if not self.config.get('fragment'):
+            return
+
+        typeset = self.typeset_page(html, page)
+        if typeset is None:
+            return
+        # the HTML before heti is kept for the other plugins
+        page.heti_source = html
+        if not self.config.get('search_original'):
+            return typeset
+        # html stays in page.content for the search index, see on_page_context
+        page.heti_content = typeset
+        return html
+
+    def on_env(self, env, *, config: config_options.Config, files: Files):
+        if self.config.get('fragment') and self.pending:
+            # every page has been rendered and none has been put in its
+            # template yet
+            self.process_pending(self.set_content)
+        return env
+
+    def set_content(self, page: Page, source: str, html: str) -> None:
+        # source is the page.content heti typeset, the plugins after heti in
+        # on_page_content may have changed page.content since
+        page.heti_source = source
+        if self.config.get('search_original'):
+            page.heti_content = html
+        elif page.content == source:
+            page.content = html
+        else:
+            page.heti_source = page.content
+            page.content = self.typeset_page(page.content, page, defer=False)
+
+    @event_priority(-100)
+    def on_page_context(self, context, *, page: Page, config: config_options.Config, nav: Navigation):
+        # after the search plugin has read page.content, and just before the
+        # page is put in its template
+        html = getattr(page, 'heti_content', None)
+        if html is None:
+            return context
+        page.heti_content = None
+        if page.content != page.heti_source:
+            # changed by another plugin after heti typeset it
+            page.heti_source = page.content
+            html = self.typeset_page(page.content, page, defer=False)
+        if html is not None:
+            page.content = html
+        return context
+
+    def on_post_template(self, output_content: str, *, template_name: str, config: config_options.Config) -> None:
+        if not self.enabled:
+            return
         
-        if hasattr(page, 'encrypted'):
+        if not self.config.get('enabled'):
             return
 
-        # **temporarily fix**
-        # by replacing <kbd> tag with sth. like HETIkbdSTART0HETIkbdEND and remembering the content
-        # then replace them after heti's processing
-        # so is .arithmatex
-        kbd_content = []
-        while match := re.search(r"<kbd>(.*?)</kbd>", output):
-            kbd_content.append(match.group(1))
-            output = output[:match.start()] + f"HETIkbdSTART{len(kbd_content) - 1}HETIkbdEND" + output[match.end():]
-        math_content = []
-        while match := re.search(r"<span class=\"arithmatex\">(.*?)</span>", output):
-            math_content.append(match.group(1))
-            output = output[:match.start()] + f"HETImathSTART{len(math_content) - 1}HETImathEND" + output[match.end():]
+        if self.config.get('disable_serve') and self.serve:
+            return
+
+        # the static templates of the theme, e.g. 404.html, link heti.css too
+        self.link(os.path.join(config["site_dir"], template_name))
+
+    def on_post_page(self, output: str, *, page: Page, config: config_options.Config) -> Optional[str]:
+        if not self.enabled:
+            return
         
-        html = heti(output, self.config.get('root_selector'))
+        if not self.config.get('enabled'):
+            return
 
-        for i in range(len(kbd_content)):
-            html = html.replace(f"HETIkbdSTART{i}HETIkbdEND", f"<kbd>{kbd_content[i]}</kbd>")
-        for i in range(len(math_content)):
-            html = html.replace(f"HETImathSTART{i}HETImathEND", f"<span class=\"arithmatex\">{math_content[i]}</span>")
+        if self.config.get('disable_serve') and self.serve:
+            return
+
+        self.link(page.file.abs_dest_path)
+        if self.config.get('fragment'):
+            self.track(output)
+            return
+
+        html = self.typeset_page(output, page)
+        self.track(html)
+        return html
+
+    def link(self, path: str) -> None:
+        # the pages to link to the hashed heti.css, see write_css
+        if self.config.get('css_hash') and not self.serve:
+            self.pages.append(path)
+
+    def track(self, html: Optional[str]) -> None:
+        if html is not None and self.config.get('css_subset'):
+            self.names |= hetiNames(html)
+
+    def typeset_page(self, output: str, page: Page, defer: bool = True) -> Optional[str]:
+        # output is the whole page, or page.content in fragment mode; with
+        # defer and workers > 1 it is typeset later, see process_pending
+        if hasattr(page, 'encrypted'):
+            return
+
+        key = None
+        if self.cache or self.memo is not None:
+            key = HetiCache.key(output, __version__, HETI_OUTPUT_HASH, self.options)
+
+        if self.memo is not None:
+            # serve: only the pages changed since the last rebuild are typeset
+            memo = self.memo.get(page.file.src_uri)
+            if memo and memo[0] == key:
+                self.reused += 1
+                self.built[page.file.src_uri] = memo
+                return memo[1]
+
+        if self.cache:
+            html = self.cache.get(key)
+            if html is not None:
+                self.remember(page.file.src_uri, key, html)
+                return html
+
+        if defer and self.config.get('workers') > 1:
+            # typeset later in parallel with the other pages, in on_env for
+            # the fragments and in on_post_build for the whole pages
+            self.pending.append((page, output, key))
+            return
+
+        profile = None
+        if self.config.get('profile'):
+            profile = {"page": page.file.src_uri}
+            self.profiles.append(profile)
+
+        start = time.perf_counter()
+        if self.match_memo:
+            hits, misses = self.match_memo.hits, self.match_memo.misses
+        html = heti_page(output, self.options, memo=self.match_memo, profile=profile)
+        if self.match_memo:
+            self.memo_hits += self.match_memo.hits - hits
+            self.memo_misses += self.match_memo.misses - misses
+        self.typeset += 1
+        self.typeset_time += time.perf_counter() - start
+        if self.options.large_page_size and len(output) > self.options.large_page_size:
+            # only the soup engine typesets large pages in blocks; ru_maxrss
+            # is the peak of the whole process so far, not of this page
+            rss = maxRss()
+            log.info(
+                f"heti: {page.file.src_uri} is a large page of {len(output) / 1024 / 1024:.1f} MB"
+                + (", typeset in blocks" if self.options.engine == "soup" else "")
+                + (f", process peak RSS {rss / 1024:.0f} MB" if rss else "")
+            )
+
+        if self.cache:
+            self.cache.set(key, html)
+        self.remember(page.file.src_uri, key, html)
         
         return html
 
+    def remember(self, src_uri: str, key: str, html: str) -> None:
+        if self.memo is not None:
+            self.built[src_uri] = (key, html)
+
+    @event_priority(100)
     def on_post_build(self, config: Dict[str, Any], **kwargs) -> None:
+        # first, so that the other plugins see the pages typeset with
+        # workers > 1 and the final heti.css
         if not self.enabled:
             return
         
@@ -98,9 +339,91 @@ class HetiPlugin(BasePlugin):
         if self.config.get('disable_serve') and self.serve:
             return
         
-        files = ["css/heti.css"]
-        for file in files:
-            dest_file_path = os.path.join(config["site_dir"], file)
-            src_file_path = os.path.join(PLUGIN_DIR, file)
-            assert os.path.exists(src_file_path)
-            copy_file(src_file_path, dest_file_path)
\ No newline at end of file
+        if self.pending:
+            def done(page: Page, output: str, html: str) -> None:
+                write_file(html.encode('utf-8', errors='xmlcharrefreplace'), page.file.abs_dest_path)
+                self.track(html)
+
+            self.process_pending(done)
+
+        self.write_css(config["site_dir"])
+
+        if self.cache:
+            self.cache.evict()
+
+        if self.memo is not None:
+            # pages removed since the last build are forgotten
+            self.memo, self.built = self.built, {}
+            log.info(
+                f"heti: typeset {self.typeset} page(s) in {self.typeset_time:.2f}s, "
+                f"reused {self.reused} unchanged page(s)"
+            )
+
+        if self.profiles:
+            for line in summarize(self.profiles, self.config.get('profile_top')):
+                log.info(line)
+            if self.config.get('profile_report'):
+                report = os.path.join(config["site_dir"], self.config.get('profile_report'))
+                writeReport(self.profiles, report)
+                log.info(f"heti: profile written to {report}")
+
+        if self.memo_hits or self.memo_misses:
+            # a low rate of hits with a full memo means match_memo_size is too small
+            level = logging.INFO if self.config.get('profile') else logging.DEBUG
+            log.log(
+                level,
+                f"heti: match memo {self.memo_hits} hit(s), {self.memo_misses} miss(es)"
+                + (f", {len(self.match_memo.spans)}/{self.match_memo.maxSize} text(s) in memo" if self.match_memo and self.match_memo.spans else "")
+            )
+
+    def write_css(self, site_dir: str) -> None:
+        # with --dirty the pages that are not built again are not tracked,
+        # they get the whole stylesheet
+        subset = self.config.get('css_subset') and not self.dirty
+        # the file name changes on every rebuild of serve otherwise
+        hashed = self.config.get('css_hash') and not self.serve
+        if not subset and not hashed:
+            copy_file(HETI_CSS_DIR, os.path.join(site_dir, "css/heti.css"))
+            return
+        css = minifyCss(subsetCss(HETI_CSS, self.names) if subset else HETI_CSS)
+        name = "css/heti.css"
+        if hashed:
+            name = f"css/heti.{hashlib.sha256(css.encode('utf-8')).hexdigest()[:8]}.css"
+            # the theme has linked css/heti.css from extra_css already
+            for path in self.pages:
+                try:
+                    with open(path, 'r', encoding='utf-8') as file:
+                        html = file.read()
+                except OSError:
+                    continue
+                linked = html.replace('css/heti.css"', f'{name}"')
+                if linked != html:
+                    write_file(linked.encode('utf-8'), path)
+        write_file(css.encode('utf-8'), os.path.join(site_dir, name))
+        log.debug(f"heti: wrote {name}, {len(css)} bytes")
+
+    def process_pending(self, done: Callable[[Page, str, str], None]) -> None:
+        pending, self.pending = self.pending, []
+        start = time.perf_counter()
+        workers = min(self.config.get('workers'), len(pending))
+        with worker_pool(self.config.get('executor'), workers, self.config.get('match_memo_size')) as executor:
+            profile = self.config.get('profile')
+            results = executor.map(
+                heti_page_worker,
+                [output for _, output, _ in pending],
+                repeat(self.options),
+                repeat(profile),
+                chunksize=max(1, len(pending) // (workers * 4)),
+            )
+            for (page, output, key), (html, page_profile, hits, misses) in zip(pending, results):
+                if profile:
+                    page_profile["page"] = page.file.src_uri
+                    self.profiles.append(page_profile)
+                self.memo_hits += hits
+                self.memo_misses += misses
+                done(page, output, html)
+                if self.cache:
+                    self.cache.set(key, html)
+                self.remember(page.file.src_uri, key, html)
+        self.typeset += len(pending)
+        self.typeset_time += time.perf_counter() - start
@@ -0,0 +1,137 @@
+import re
+from html import escape
+from typing import Iterator, List, Optional, Set
+
+import lxml.html
+from lxml import etree
+from lxml.cssselect import CSSSelector
+
+from .finder import MatchMemo
+from .heti import HETI_ELEMENTS, HETI_PROTECTED_SELECTORS, HetiElements, heti
+
+REG_BLOCK_PLACEHOLDER = re.compile(r"<!--HETIblock(\d+)END-->")
+# a forced element with more elements than this in it is split in turn
+HETI_BLOCK_ELEMENTS = 1000
+
+class HetiBlocks:
+    """
+    Large pages: the page is parsed by lxml, whose tree is much lighter than
+    BeautifulSoup's, and the children of each root are typeset a group at a
+    time by heti() in fragment mode, so the engine only ever holds one group.
+    A forced element starts a new context, each one is a group of its own and
+    the text and inline elements between them make up the other groups: the
+    rules match the same text as on the whole root. For the same reason a
+    large forced element, e.g. the container of a theme, is split into groups
+    like a root.
+
+    The groups are replaced by placeholder comments once typeset, which are
+    swapped for the typeset HTML when the page is serialized. The markup out
+    of the roots is serialized by lxml, and a root nested in another one is
+    only processed once.
+    """
+
+    def __init__(
+        self,
+        html: str,
+        rootSelector: str,
+        protectedSelectors: Optional[List[str]] = None,
+        *,
+        engine: str = "soup",
+        elements: Optional[HetiElements] = None,
+        memo: Optional[MatchMemo] = None,
+        compact: bool = False,
+    ):
+        self.elements = elements or HETI_ELEMENTS
+        self.engine = engine
+        self.memo = memo
+        self.compact = compact
+        self.tree = lxml.html.document_fromstring(html).getroottree()
+        # see HetiTree
+        self.doctype = html.lstrip()[:9].lower() == "<!doctype"
+        self.trailing = html[len(html.rstrip()):]
+        self.rootSelector = CSSSelector(rootSelector)
+        if protectedSelectors is None:
+            protectedSelectors = HETI_PROTECTED_SELECTORS
+        self.protectedSelectors = protectedSelectors
+        self.protectedSelector = CSSSelector(", ".join(protectedSelectors)) if protectedSelectors else None
+        self.blocks = []
+
+    def isForced(self, element: etree.ElementBase, protected: Set[etree.ElementBase]) -> bool:
+        # protected elements are placeholder text while typesetting, so they
+        # never start a group
+        return isinstance(element.tag, str) and self.elements.isForced(element.tag) and element not in protected
+
+    def isLarge(self, element: etree.ElementBase, protected: Set[etree.ElementBase]) -> bool:
+        return (
+            self.isForced(element, protected) and
+            not self.elements.isSkipped(element.tag, (element.get("class") or "").split()) and
+            sum(1 for _ in element.iter()) > HETI_BLOCK_ELEMENTS
+        )
+
+    def groups(self, root: etree.ElementBase, protected: Set[etree.ElementBase]) -> Iterator[list]:
+        # the text of the root and its children with their tails, grouped
+        # between the forced elements
+        group = [root.text] if root.text else []
+        for child in root:
+            if self.isForced(child, protected):
+                if group:
+                    yield group
+                yield [child]
+                group = []
+            else:
+                group.append(child)
+            if child.tail:
+                group.append(child.tail)
+        if group:
+            yield group
+
+    def serialize(self, group: list) -> str:
+        parts = []
+        for item in group:
+            if isinstance(item, str):
+                parts.append(escape(item, quote=False))
+            else:
+                parts.append(etree.tostring(item, encoding="unicode", method="html", with_tail=False))
+        return "".join(parts)
+
+    def spacingRoot(self, root: etree.ElementBase, protected: Set[etree.ElementBase]) -> None:
+        # the groups are read before the root is changed
+        groups = list(self.groups(root, protected))
+        root.text = None
+        for child in list(root):
+            root.remove(child)
+        for group in groups:
+            if len(group) == 1 and not isinstance(group[0], str) and self.isLarge(group[0], protected):
+                # its tail is in the next group
+                group[0].tail = None
+                root.append(group[0])
+                self.spacingRoot(group[0], protected)
+                continue
+            html = heti(
+                self.serialize(group),
+                None,
+                self.protectedSelectors,
+                engine=self.engine,
+                elements=self.elements,
+                fragment=True,
+                memo=self.memo,
+                compact=self.compact,
+            )
+            # the elements of the group are not referenced anymore
+            group.clear()
+            placeholder = etree.Comment(f"HETIblock{len(self.blocks)}END")
+            root.append(placeholder)
+            self.blocks.append(html)
+
+    def spacing(self) -> str:
+        roots = self.rootSelector(self.tree)
+        rootSet = set(roots)
+        roots = [root for root in roots if not any(parent in rootSet for parent in root.iterancestors())]
+        for root in roots:
+            if isinstance(root.tag, str) and not self.elements.isSkipped(root.tag, (root.get("class") or "").split()):
+                protected = set(self.protectedSelector(root)) if self.protectedSelector is not None else set()
+                self.spacingRoot(root, protected)
+        html = etree.tostring(self.tree if self.doctype else self.tree.getroot(), encoding="unicode", method="html")
+        if self.blocks:
+            html = REG_BLOCK_PLACEHOLDER.sub(lambda match: self.blocks[int(match.group(1))], html)
+        return html + self.trailing
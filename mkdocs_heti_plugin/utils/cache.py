@@ -0,0 +1,128 @@
+import hashlib
+import os
+import tempfile
+import time
+from typing import Optional
+
+CACHE_SUFFIX = ".html"
+TEMPORARY_SUFFIX = ".tmp"
+# a temporary file older than this was left by an interrupted build, a newer
+# one can still be written by a concurrent build
+TEMPORARY_MAX_AGE = 3600
+
+UTILS_DIR = os.path.dirname(os.path.abspath(__file__))
+# the modules whose code makes the output of heti: a change to any of them,
+# e.g. to a rule, makes the entries of the cache stale even without a new
+# __version__
+HETI_OUTPUT_MODULES = [
+    "heti.py", "finder.py", "runs.py", "stream.py", "tree.py", "blocks.py", "protect.py", "pool.py",
+]
+
+def outputHash() -> str:
+    h = hashlib.sha256()
+    for name in HETI_OUTPUT_MODULES:
+        try:
+            with open(os.path.join(UTILS_DIR, name), "rb") as file:
+                h.update(file.read())
+        except OSError:
+            # installed without its sources, __version__ still tells
+            h.update(name.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+HETI_OUTPUT_HASH = outputHash()
+
+class HetiCache:
+    def __init__(self, cacheDir: str, maxSize: int):
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cacheDir, exist_ok=True)
+        self.removeTemporary()
+
+    def removeTemporary(self) -> None:
+        # the temporary files of the writes that never finished
+        now = time.time()
+        for root, _, files in os.walk(self.cacheDir):
+            for name in files:
+                if not name.endswith(TEMPORARY_SUFFIX):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    if now - os.stat(path).st_mtime > TEMPORARY_MAX_AGE:
+                        os.remove(path)
+                except OSError:
+                    continue
+
+    @staticmethod
+    def key(html: str, *parts) -> str:
+        h = hashlib.sha256()
+        for part in parts:
+            h.update(repr(part).encode("utf-8"))
+            h.update(b"\0")
+        h.update(html.encode("utf-8"))
+        return h.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cacheDir, key[:2], key + CACHE_SUFFIX)
+
+    def get(self, key: str) -> Optional[str]:
+        path = self.path(key)
+        try:
+            # newline="" on both sides, the \r of a page is kept as is
+            with open(path, "r", encoding="utf-8", newline="") as file:
+                content = file.read()
+        except OSError:
+            self.misses += 1
+            return None
+        # the mtime of an entry is its last use, which eviction relies on
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return content
+
+    def set(self, key: str, content: str) -> None:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file and rename it, so that a concurrent build
+        # never reads a partially written entry
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path), suffix=TEMPORARY_SUFFIX)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8", newline="") as file:
+                file.write(content)
+            os.replace(tmpPath, path)
+        except BaseException:
+            try:
+                os.remove(tmpPath)
+            except OSError:
+                pass
+            raise
+
+    def evict(self) -> None:
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.cacheDir):
+            for name in files:
+                if not name.endswith(CACHE_SUFFIX):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        if total <= self.maxSize:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            if total <= self.maxSize:
+                break
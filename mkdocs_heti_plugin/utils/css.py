@@ -0,0 +1,32 @@
+import re
+from typing import Iterable, Set
+
+# the classes and elements heti adds to a page, as named in heti.css
+REG_HETI_NAME = re.compile(r"heti-[a-z-]+")
+REG_CSS_COMMENT = re.compile(r"/\*.*?\*/", re.S)
+REG_CSS_RULE = re.compile(r"([^{}]+)\{([^{}]*)\}")
+
+def hetiNames(html: str) -> Set[str]:
+    return set(REG_HETI_NAME.findall(html))
+
+def subsetCss(css: str, names: Iterable[str]) -> str:
+    # keeps the selectors whose heti classes and elements are all in names,
+    # heti.css has no at-rules or nested blocks
+    names = set(names)
+    rules = []
+    for match in REG_CSS_RULE.finditer(REG_CSS_COMMENT.sub("", css)):
+        selectors = [
+            selector.strip() for selector in match.group(1).split(",")
+            if set(REG_HETI_NAME.findall(selector)) <= names
+        ]
+        if selectors:
+            rules.append((selectors, match.group(2)))
+    return "\n".join(f"{', '.join(selectors)} {{{body}}}" for selectors, body in rules)
+
+def minifyCss(css: str) -> str:
+    css = REG_CSS_COMMENT.sub("", css)
+    css = re.sub(r"\s+", " ", css)
+    # a space before a colon can be a descendant combinator, as in `a :hover`
+    css = re.sub(r"\s*([{};,>])\s*", r"\1", css)
+    css = re.sub(r":\s+", ":", css)
+    return css.replace(";}", "}").strip()
@@ -1,5 +1,11 @@
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
 import bs4
 
+ASCII_SPACES = "\x20\x0a\x09\x0c\x0d"
+
 def substring(text, start, end = None):
     if end is None:
         end = len(text)
@@ -9,186 +15,368 @@ def substring(text, start, end = None):
         return text[end:start]
     return text[start:end]
 
+def searchText(regex, text):
+    startPos = 0
+    while True:
+        # the rules used to start with .*? and were matched from startPos,
+        # which stops at the first line without a match
+        lineEnd = text.find("\n", startPos)
+        if lineEnd < 0:
+            lineEnd = len(text)
+        match = regex.search(text, startPos, lineEnd)
+        if not match:
+            return
+        yield match
+        startPos = match.end()
+
+def matchGroup(match):
+    # the last group that took part in the match, or the only one
+    idx = 1
+    if len(match.groups()) != 1:
+        for i in range(len(match.groups())):
+            if match.group(i + 1):
+                idx = i + 1
+    return idx
+
+def searchSpans(regex, text):
+    # the (start, end) of the group of each match
+    spans = []
+    for match in searchText(regex, text):
+        if not match.group():
+            raise Exception("cannot handle zero-length matches")
+        idx = matchGroup(match)
+        spans.append((match.start(idx), match.end(idx)))
+    return tuple(spans)
+
+class MatchMemo:
+    """
+    The spans searchSpans finds for a rule in a text, for the texts found on
+    many pages: titles of admonitions, headers of tables, snippets, labels of
+    the nav. At most maxSize texts are kept, the least recently used ones are
+    dropped first.
+
+    It is not thread-safe, each thread typesetting pages has its own, see
+    init_worker in pool.py.
+    """
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.spans = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def search(self, regex, text):
+        key = (regex, text)
+        spans = self.spans.get(key)
+        if spans is not None:
+            self.spans.move_to_end(key)
+            self.hits += 1
+            return spans
+        self.misses += 1
+        spans = searchSpans(regex, text)
+        self.spans[key] = spans
+        if len(self.spans) > self.maxSize:
+            self.spans.popitem(last=False)
+        return spans
+
+class TextAggregation:
+    """
+    The text of a root split into contexts, each one a flat list of its text
+    nodes. It is built once and shared by the Finders of every rule: a Finder
+    only updates the contexts it changed, and normalize() follows the strings
+    normalizeStrings replaced in them.
+    """
+
+    def __init__(self, node, filterElements, forceContext):
+        self.filterElements = filterElements
+        self.forceContext = forceContext
+        self.contexts = self.getContexts(node)
+        self.texts = [None] * len(self.contexts)
+        self.ends = [None] * len(self.contexts)
+        # contexts changed since the last normalize()
+        self.changed = []
+
+    def getContexts(self, node):
+        # same as findAndReplaceDOMText's getAggregateText, flattened: a new
+        # context starts around the forced elements, and after an element
+        # that has one inside
+        if self.filterElements and (not self.filterElements(node)):
+            return []
+        contexts = [[]]
+        for child in node.children:
+            if isinstance(child, bs4.element.NavigableString):
+                contexts[-1].append(child)
+                continue
+            inner = self.getContexts(child)
+            if (
+                self.forceContext and
+                isinstance(child, bs4.element.Tag) and
+                self.forceContext(child)
+            ):
+                contexts.extend(inner)
+                contexts.append([])
+            elif inner:
+                contexts[-1].extend(inner[0])
+                if len(inner) > 1:
+                    contexts.extend(inner[1:])
+                    contexts.append([])
+        return contexts
+
+    def getNodes(self, node):
+        # the text nodes of a replacement, which never has a forced element
+        if isinstance(node, bs4.element.NavigableString):
+            return [node]
+        if self.filterElements and (not self.filterElements(node)):
+            return []
+        nodes = []
+        for child in node.children:
+            nodes.extend(self.getNodes(child))
+        return nodes
+
+    def getText(self, index):
+        if self.texts[index] is None:
+            self.texts[index] = "".join(self.contexts[index])
+        return self.texts[index]
+
+    def getEnds(self, index):
+        # the offset each text node of the context ends at
+        if self.ends[index] is None:
+            ends = []
+            textLength = 0
+            for node in self.contexts[index]:
+                textLength += len(node)
+                ends.append(textLength)
+            self.ends[index] = ends
+        return self.ends[index]
+
+    def update(self, index, nodes):
+        self.contexts[index] = nodes
+        self.texts[index] = None
+        self.ends[index] = None
+        self.changed.append(index)
+
+    def normalize(self, replaced):
+        changed, self.changed = self.changed, []
+        for index in set(changed):
+            nodes = []
+            for node in self.contexts[index]:
+                node = replaced.get(id(node), node)
+                if node is not None:
+                    nodes.append(node)
+            self.contexts[index] = nodes
+            self.texts[index] = None
+            self.ends[index] = None
+
+
 class Finder:
     def __init__(self, soup, node, options: dict):
-        if not options.get("offset"):
-            options["offset"] = 0
+        # options is only read, the same one can be used by many Finders
         self.soup = soup
         self.node = node
         self.options = options
+        self.offset = options.get("offset") or 0
+        self.newStrings = []
+        if not options.get("profile"):
+            self.matches = self.search()
+            if self.matches:
+                self.processMatches()
+            return
+        start = time.perf_counter()
         self.matches = self.search()
+        self.searchTime = time.perf_counter() - start
+        start = time.perf_counter()
         if self.matches:
             self.processMatches()
+        self.replaceTime = time.perf_counter() - start
     
     def search(self):
         self._matchIndex = 0
         self._offset = 0
         self._regex = self.options["find"]
+        # text without the characters the rule needs cannot match
+        self._prefilter = self.options.get("prefilter")
+        # spans of the texts already searched, shared between pages
+        self._memo = self.options.get("memo")
         self._textAggregation = self.getAggregateText()
         self._matches = []
+        # the offset each context starts at
+        self._contextOffsets = []
 
-        def matchAggregation(textAggregation):
-            for text in textAggregation:
-                if not isinstance(text, str):
-                    matchAggregation(text)
-                    continue
-                startPos = 0
-                while match := self._regex.match(text, startPos):
-                    self._matches.append(self.prepMatch(match, self._matchIndex, self._offset))
-                    self._matchIndex += 1
-                    startPos = match.end()
+        for index in range(len(self._textAggregation.contexts)):
+            text = self._textAggregation.getText(index)
+            self._contextOffsets.append(self._offset)
+            if self._prefilter and not self._prefilter.search(text):
                 self._offset += len(text)
-        
-        matchAggregation(self._textAggregation)
+                continue
+            if self._memo:
+                spans = self._memo.search(self._regex, text)
+            else:
+                spans = searchSpans(self._regex, text)
+            for start, end in spans:
+                d = self.prepMatch(text, start, end, self._matchIndex, self._offset)
+                d["context"] = index
+                self._matches.append(d)
+                self._matchIndex += 1
+            self._offset += len(text)
         return self._matches
 
-    def prepMatch(self, match, matchIndex, characterOffset):
-        if not match.group():
-            raise Exception("cannot handle zero-length matches")
+    def prepMatch(self, text, start, end, matchIndex, characterOffset):
         d = dict()
-        idx = 1
-        if len(match.groups()) != 1:
-            for i in range(len(match.groups())):
-                if match.group(i + 1):
-                    idx = i + 1
-        d["text"] = match.group(idx)
-        d["endIndex"] = characterOffset + match.end(idx)
-        d["startIndex"] = characterOffset + match.start(idx)
+        d["text"] = text[start:end]
+        d["endIndex"] = characterOffset + end
+        d["startIndex"] = characterOffset + start
         d["index"] = matchIndex
-        d["match"] = match
         return d
     
     def getAggregateText(self):
-        self._elementFilter = self.options["filterElements"]
-        self._forceContext = self.options["forceContext"]
-
-        def getText(node):
-            if isinstance(node, bs4.element.NavigableString):
-                return [str(node)]
-            if self._elementFilter and (not self._elementFilter(node)):
-                return []
-            txt = ['']
-            for child in node.children:
-                if isinstance(child, bs4.element.NavigableString):
-                    txt[-1] += str(child)
-                    continue
-                innerText = getText(child)
-                if (
-                    self._forceContext and 
-                    isinstance(child, bs4.element.Tag) and
-                    self._forceContext(child)
-                ):
-                    txt.append(innerText)
-                    txt.append('')
-                else:
-                    if len(innerText) > 0 and isinstance(innerText[0], str):
-                        txt[-1] += innerText.pop(0)
-                    if len(innerText):
-                        txt.append(innerText)
-                        txt.append('')
-            return txt
-        
-        return getText(self.node)
+        # shared by the rules when given in the options
+        if self.options.get("aggregation"):
+            return self.options["aggregation"]
+        return TextAggregation(self.node, self.options["filterElements"], self.options["forceContext"])
     
     def processMatches(self):
-        matches = self.matches
-        node = self.node
-        elementFilter = self.options["filterElements"]
-        startPortion = None
-        endPortion = None
-        innerPortions = []
-        curNode = node
-        match = matches.pop(0)
-        atIndex = 0
-        portionIndex = 0
-        doAvoidNode = None
-        nodeStack = [node]
-
-        while True:
-            if isinstance(curNode, bs4.element.NavigableString):
-                if (not endPortion) and (len(curNode) + atIndex >= match["endIndex"]):
+        # the matches are sorted and do not overlap, so they are applied in
+        # one sweep over the text nodes of each context, each one found by
+        # binary search
+        offset = self.offset
+        aggregation = self._textAggregation
+        # the nodes replaced, by id, put in the tree by replaceNodes
+        self._replaced = dict()
+        matchIndex = 0
+        while matchIndex < len(self.matches):
+            context = self.matches[matchIndex]["context"]
+            contextOffset = self._contextOffsets[context]
+            nodes = list(aggregation.contexts[context])
+            ends = aggregation.getEnds(context)
+            newNodes = []
+            i = 0
+            while matchIndex < len(self.matches) and self.matches[matchIndex]["context"] == context:
+                match = self.matches[matchIndex]
+                matchIndex += 1
+                startIndex = match["startIndex"] - contextOffset
+                endIndex = match["endIndex"] - contextOffset
+                # the first node ending after the start of the match, and the
+                # first one from there reaching its end
+                first = bisect_right(ends, startIndex, i)
+                last = bisect_left(ends, endIndex, first)
+                newNodes.extend(nodes[i:first])
+                curNode = nodes[first]
+                atIndex = ends[first] - len(curNode)
+                text = substring(curNode.string, startIndex - atIndex + offset, endIndex - atIndex)
+                innerPortions = []
+                if first == last:
                     endPortion = Portion(
                         node = curNode,
-                        index = portionIndex,
-                        text = substring(curNode.string, match["startIndex"] - atIndex + self.options["offset"], match["endIndex"] - atIndex),
-                        indexInMatch = 0 if atIndex == 0 else atIndex - match["startIndex"],
-                        indexInNode = match["startIndex"] - atIndex + self.options["offset"],
-                        endIndexInNode = match["endIndex"] - atIndex,
+                        index = 0,
+                        text = text,
+                        indexInMatch = 0 if atIndex + contextOffset == 0 else atIndex - startIndex,
+                        indexInNode = startIndex - atIndex + offset,
+                        endIndexInNode = endIndex - atIndex,
                         isEnd = True
                     )
-                    portionIndex += 1
-                elif startPortion:
-                    innerPortions.append(Portion(
+                    startPortion = Portion(
                         node = curNode,
-                        index = portionIndex,
-                        text = curNode.string,
-                        indexInMatch = atIndex - match["startIndex"],
-                        indexInNode = 0
-                    ))
-                    portionIndex += 1
-                
-                if (not startPortion) and (len(curNode) + atIndex > match["startIndex"]):
+                        index = 1,
+                        indexInMatch = 0,
+                        indexInNode = startIndex - atIndex + offset,
+                        endIndexInNode = endIndex - atIndex,
+                        text = text,
+                    )
+                else:
                     startPortion = Portion(
                         node = curNode,
-                        index = portionIndex,
+                        index = 0,
                         indexInMatch = 0,
-                        indexInNode = match["startIndex"] - atIndex + self.options["offset"],
-                        endIndexInNode = match["endIndex"] - atIndex,
-                        text = substring(curNode.string, match["startIndex"] - atIndex + self.options["offset"], match["endIndex"] - atIndex),
+                        indexInNode = startIndex - atIndex + offset,
+                        endIndexInNode = endIndex - atIndex,
+                        text = text,
                     )
-                    portionIndex += 1
-                
-                atIndex += len(curNode.string)
-            
-            doAvoidNode = isinstance(curNode, bs4.element.Tag) and elementFilter and (not elementFilter(curNode))
-
-            if startPortion and endPortion:
-                curNode = self.replaceMatch(match, startPortion, innerPortions, endPortion)
-                atIndex -= (len(endPortion.node.string) - endPortion.endIndexInNode)
-                startPortion = None
-                endPortion = None
-                innerPortions = []
-                match = matches.pop(0) if len(matches) else None
-                portionIndex = 0
-                if match is None:
-                    break
-            elif (
-                (not doAvoidNode) and 
-                ((hasattr(curNode, "children") and len(list(curNode.children)) > 0) or 
-                 (hasattr(curNode, "next_sibling") and curNode.next_sibling))
-            ):
-                if hasattr(curNode, "children") and len(list(curNode.children)) > 0:
-                    nodeStack.append(curNode)
-                    curNode = list(curNode.children)[0]
+                    for j in range(first + 1, last):
+                        innerPortions.append(Portion(
+                            node = nodes[j],
+                            index = j - first,
+                            text = nodes[j].string,
+                            indexInMatch = ends[j] - len(nodes[j]) - startIndex,
+                            indexInNode = 0
+                        ))
+                    curNode = nodes[last]
+                    atIndex = ends[last] - len(curNode)
+                    endPortion = Portion(
+                        node = curNode,
+                        index = last - first,
+                        text = substring(curNode.string, startIndex - atIndex + offset, endIndex - atIndex),
+                        indexInMatch = 0 if atIndex + contextOffset == 0 else atIndex - startIndex,
+                        indexInNode = startIndex - atIndex + offset,
+                        endIndexInNode = endIndex - atIndex,
+                        isEnd = True
+                    )
+                replacement = self.replaceMatch(match, startPortion, innerPortions, endPortion)
+                if endPortion.endIndexInNode < len(endPortion.node.string):
+                    # the rest of the last node takes its place, the next
+                    # match may be in it
+                    nodes[last] = replacement.pop()
+                    i = last
                 else:
-                    curNode = curNode.next_sibling
-                continue
-                
-            while True:
-                if hasattr(curNode, "next_sibling") and curNode.next_sibling != None:
-                    curNode = curNode.next_sibling
-                    break
-                curNode = nodeStack.pop()
-                if curNode == node:
-                    return
+                    i = last + 1
+                for node in replacement:
+                    newNodes.extend(aggregation.getNodes(node))
+            newNodes.extend(nodes[i:])
+            aggregation.update(context, newNodes)
+        self.replaceNodes()
+
+    def replace(self, node, newNodes):
+        # the rest of a node split by a match may be split again by the next
+        # one before any of them is in the tree
+        self._replaced[id(node)] = (node, newNodes)
+
+    def replaceNodes(self):
+        # replace_with looks each node up in its parent, for every match that
+        # is quadratic in the number of children. Each parent changed gets
+        # its children again once, from the first one replaced
+        parents = dict()
+        for node, _ in self._replaced.values():
+            if node.parent is not None:
+                parents[id(node.parent)] = node.parent
+        for parent in parents.values():
+            contents = parent.contents
+            first = 0
+            while id(contents[first]) not in self._replaced:
+                first += 1
+            children = []
+            stack = list(reversed(contents[first:]))
+            while stack:
+                node = stack.pop()
+                replacement = self._replaced.get(id(node))
+                if replacement and replacement[0] is node:
+                    stack.extend(reversed(replacement[1]))
+                else:
+                    children.append(node)
+            for index in range(len(contents) - 1, first - 1, -1):
+                contents[index].extract(_self_index=index)
+            parent.extend(children)
+        self._replaced = dict()
     
     def replaceMatch(self, match, startPortion, innerPortions, endPortion):
+        # returns the new nodes in order, the text after the match last
         matchStartNode = startPortion.node
         matchEndNode = endPortion.node
         preceedingTextNode = None
         followingTextNode = None
+        # the tree is only changed by replaceNodes, once all the matches of the
+        # rule are found
         if matchStartNode == matchEndNode:
             node = matchStartNode
+            newNodes = []
             if startPortion.indexInNode > 0:
                 preceedingTextNode = substring(node.string, 0, startPortion.indexInNode)
-                node.insert_before(self.soup.new_string(preceedingTextNode))
+                newNodes.append(self.newString(preceedingTextNode))
             newNode = self.getPortionReplacementNode(endPortion, match)
-            node.insert_before(newNode)
+            newNodes.append(newNode)
             if endPortion.endIndexInNode < len(node.string):
                 followingTextNode = substring(node.string, endPortion.endIndexInNode)
-                node.insert_before(self.soup.new_string(followingTextNode))
-            node.extract()
-            return newNode
+                newNodes.append(self.newString(followingTextNode))
+            self.replace(node, list(newNodes))
+            return newNodes
         else:
             preceedingTextNode = substring(matchStartNode.string, 0, startPortion.indexInNode)
             followingTextNode = substring(matchEndNode.string, endPortion.endIndexInNode)
@@ -196,27 +384,77 @@ class Finder:
             innerNodes = []
             for portion in innerPortions:
                 innerNode = self.getPortionReplacementNode(portion, match)
-                portion.node.replace_with(innerNode)
+                self.replace(portion.node, [innerNode])
                 innerNodes.append(innerNode)
             lastNode = self.getPortionReplacementNode(endPortion, match)
-            matchStartNode.insert_before(self.soup.new_string(preceedingTextNode))
-            matchStartNode.insert_before(firstNode)
-            matchStartNode.extract()
-            matchEndNode.insert_before(lastNode)
-            matchEndNode.insert_before(self.soup.new_string(followingTextNode))
-            matchEndNode.extract()
-            return lastNode
+            preceedingTextNode = self.newString(preceedingTextNode)
+            followingTextNode = self.newString(followingTextNode)
+            self.replace(matchStartNode, [preceedingTextNode, firstNode])
+            self.replace(matchEndNode, [lastNode, followingTextNode])
+            return [preceedingTextNode, firstNode, *innerNodes, lastNode, followingTextNode]
     
     def getPortionReplacementNode(self, portion, match=None):
         replacement = self.options["replace"] if self.options.get("replace") else "$&"
         if callable(replacement):
             if portion.text == " ":
-                return self.soup.new_string("")
+                return self.newString("")
             # print(f"replacement(portion={portion}, match={match})")
             replacement = replacement(portion, self.soup)
             if replacement and isinstance(replacement, bs4.element.Tag):
                 return replacement
-            return self.soup.new_string(replacement)
+            return self.newString(replacement)
+
+    def newString(self, text):
+        node = self.soup.new_string(text)
+        self.newStrings.append(node)
+        return node
+
+
+def normalizeStrings(soup, nodes):
+    # make the parents of the strings created by replacements look like they
+    # were serialized and parsed again, like BeautifulSoup does: adjacent
+    # strings merged, no empty strings, and whitespace-only strings collapsed
+    # to a single space or newline. Returns the strings replaced, by id, with
+    # the new string or None when removed
+    replaced = dict()
+    parents = dict()
+    for node in nodes:
+        if node.parent is not None:
+            parents[id(node.parent)] = node.parent
+    for parent in parents.values():
+        children = list(parent.children)
+        # the index of children[i] in the parent, given to extract and insert
+        # so that they do not look it up
+        position = 0
+        i = 0
+        while i < len(children):
+            child = children[i]
+            if type(child) is not bs4.element.NavigableString:
+                position += 1
+                i += 1
+                continue
+            j = i + 1
+            while j < len(children) and type(children[j]) is bs4.element.NavigableString:
+                j += 1
+            text = "".join(children[i:j])
+            if text and not text.strip(ASCII_SPACES):
+                text = "\n" if "\n" in text else " "
+            if j - i > 1 or text != child:
+                for extra in children[i + 1:j]:
+                    extra.extract(_self_index=position + 1)
+                    replaced[id(extra)] = None
+                child.extract(_self_index=position)
+                if text:
+                    string = soup.new_string(text)
+                    parent.insert(position, string)
+                    replaced[id(child)] = string
+                    position += 1
+                else:
+                    replaced[id(child)] = None
+            else:
+                position += 1
+            i = j
+    return replaced
 
 
 class Portion():
@@ -1,10 +1,11 @@
 import re
-from typing import List
+import time
+from typing import Iterable, List, Optional, Tuple
 
 import bs4
 from bs4 import BeautifulSoup
 
-from .finder import Finder
+from .finder import Finder, MatchMemo, TextAggregation, normalizeStrings
 
 # Pre-defined elements and classes
 HETI_NON_CONTIGUOUS_ELEMENTS = [
@@ -27,6 +28,65 @@ HETI_SKIPPED_ELEMENTS = [
 HETI_SKIPPED_CLASS = [
     "heti-skip"
 ]
+# classes of the single span around western text in compact mode, instead of
+# spans of spaces: heti-spacing-start is a quarter em after the text and
+# heti-spacing-end one before it, see heti.css
+HETI_COMPACT_START = ["heti-spacing-start"]
+HETI_COMPACT_END = ["heti-spacing-end"]
+HETI_COMPACT_START_END = ["heti-skip", "heti-spacing-start", "heti-spacing-end"]
+# elements that are swapped for a placeholder text like
+# HETIprotectSTART0HETIprotectEND while processing, and put back afterwards
+HETI_PROTECTED_SELECTORS = [
+    "kbd", "span.arithmatex"
+]
+
+class HetiElements:
+    """
+    The elements and classes heti skips or does not read across, as frozen
+    sets of the defaults above and of the extras of the config. The decisions
+    for the names in them are made once, any other name is neither forced
+    nor skipped. Nothing changes once it is made, so one can be shared by
+    the threads typesetting pages.
+    """
+
+    def __init__(
+        self,
+        skippedClass: Iterable[str] = (),
+        skippedElements: Iterable[str] = (),
+        nonContiguousElements: Iterable[str] = (),
+    ):
+        self.skippedClass = frozenset(HETI_SKIPPED_CLASS).union(skippedClass)
+        self.skippedElements = frozenset(HETI_SKIPPED_ELEMENTS).union(skippedElements)
+        self.nonContiguousElements = frozenset(HETI_NON_CONTIGUOUS_ELEMENTS).union(nonContiguousElements)
+        # tag name -> (forced, skipped), the parsers give lowercase names
+        self.decisions = {
+            name: (name in self.nonContiguousElements, name in self.skippedElements)
+            for name in self.skippedElements | self.nonContiguousElements
+        }
+
+    def decide(self, name: str) -> Tuple[bool, bool]:
+        decision = self.decisions.get(name)
+        if decision is None:
+            lower = name.lower()
+            decision = (lower in self.nonContiguousElements, lower in self.skippedElements)
+        return decision
+
+    def isForced(self, name: str) -> bool:
+        return self.decide(name)[0]
+
+    def isSkipped(self, name: str, classList: Optional[Iterable[str]] = None) -> bool:
+        if self.decide(name)[1]:
+            return True
+        return bool(classList) and not self.skippedClass.isdisjoint(classList)
+
+    def __repr__(self) -> str:
+        # sorted, this is part of the keys of the cache
+        return (
+            f"HetiElements({sorted(self.skippedClass)!r}, {sorted(self.skippedElements)!r}, "
+            f"{sorted(self.nonContiguousElements)!r})"
+        )
+
+HETI_ELEMENTS = HetiElements()
 
 # RegEx
 CJK = "\u2e80-\u2eff\u2f00-\u2fdf\u3040-\u309f\u30a0-\u30fa\u30fc-\u30ff\u3100-\u312f\u3200-\u32ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
@@ -34,9 +94,13 @@ A = "A-Za-z\u0080-\u00ff\u0370-\u03ff"
 N = "0-9"
 S = "`~!@#\\$%\\^&\\*\\(\\)-_=\\+\\[\\]{}\\\\\\|;:'\",<.>\\/\\?"
 ANS = f"{A}{N}{S}"
-REG_CJK_FULL = rf".*?(?<=[{CJK}])( *[{ANS}]+(?: +[{ANS}]+)* *)(?=[{CJK}])"
-REG_CJK_START = rf".*?([{ANS}]+(?: +[{ANS}]+)* *)(?=[{CJK}])"
-REG_CJK_END = rf".*?(?<=[{CJK}])( *[{ANS}]+(?: +[{ANS}]+)*)"
+# the rules are searched with re.search, each pattern starts with the first
+# character it can match (or a lookbehind) instead of a leading .*?
+REG_CJK_FULL = rf"(?<=[{CJK}])( *[{ANS}]+(?: +[{ANS}]+)* *)(?=[{CJK}])"
+# starts at the beginning of a run of western text and spaces, since the rest
+# of a run cannot match if its beginning does not
+REG_CJK_START = rf"(?<![{ANS} ]) *([{ANS}]+(?: +[{ANS}]+)* *)(?=[{CJK}])"
+REG_CJK_END = rf"(?<=[{CJK}])( *[{ANS}]+(?: +[{ANS}]+)*)"
 REG_BD_STOP = r"。．，、：；！‼？⁇"
 REG_BD_SEP = r"·・‧"
 REG_BD_OPEN = r"「『（《〈【〖〔［｛"
@@ -46,9 +110,24 @@ REG_BD_END = rf"{REG_BD_STOP}{REG_BD_OPEN}{REG_BD_CLOSE}"
 REG_BD_HALF_OPEN = r"“‘"
 REG_BD_HALF_CLOSE = r"”’"
 REG_BD_HALF_START = rf"{REG_BD_HALF_OPEN}{REG_BD_HALF_CLOSE}"
-REG_BD_HALF = rf".*?(([{REG_BD_STOP}])(?=[{REG_BD_START}])|([{REG_BD_OPEN}])(?=[{REG_BD_OPEN}])|([{REG_BD_CLOSE}])(?=[{REG_BD_END}]))"
-REG_BD_QUARTER = rf".*?(([{REG_BD_SEP}])(?=[{REG_BD_OPEN}])|([{REG_BD_CLOSE}])(?=[{REG_BD_SEP}]))"
-REG_BD_QUARTER_EXTRA = rf".*?(([{REG_BD_STOP}])(?=[{REG_BD_HALF_START}])|([{REG_BD_HALF_OPEN}])(?=[{REG_BD_OPEN}]))"
+REG_BD_HALF = rf"(([{REG_BD_STOP}])(?=[{REG_BD_START}])|([{REG_BD_OPEN}])(?=[{REG_BD_OPEN}])|([{REG_BD_CLOSE}])(?=[{REG_BD_END}]))"
+REG_BD_QUARTER = rf"(([{REG_BD_SEP}])(?=[{REG_BD_OPEN}])|([{REG_BD_CLOSE}])(?=[{REG_BD_SEP}]))"
+REG_BD_QUARTER_EXTRA = rf"(([{REG_BD_STOP}])(?=[{REG_BD_HALF_START}])|([{REG_BD_HALF_OPEN}])(?=[{REG_BD_OPEN}]))"
+
+# characters without which a rule can never match, text without any of them
+# is skipped before running the rules
+REG_CJK_CHARS = rf"[{CJK}]"
+REG_BD_CHARS = rf"[{REG_BD_STOP}{REG_BD_SEP}{REG_BD_OPEN}{REG_BD_CLOSE}{REG_BD_HALF_OPEN}{REG_BD_HALF_CLOSE}]"
+COMPILED_REG_CJK_CHARS = re.compile(REG_CJK_CHARS, re.U)
+COMPILED_REG_BD_CHARS = re.compile(REG_BD_CHARS, re.U)
+COMPILED_REG_HETI_CHARS = re.compile(rf"{REG_CJK_CHARS}|{REG_BD_CHARS}", re.U)
+
+REG_PROTECTED_PLACEHOLDER = re.compile(r"HETIprotectSTART(\d+)HETIprotectEND")
+
+# number of rules applied by Heti.spacingElement, in order
+HETI_STEPS = 6
+# the characters each rule needs, see COMPILED_REG_*_CHARS below
+HETI_STEP_CHARS = ["cjk", "cjk", "cjk", "bd", "bd", "bd"]
 
 # compiled RegEx pattern
 COMPILED_REG_CJK_FULL = re.compile(REG_CJK_FULL, re.U)
@@ -59,129 +138,308 @@ COMPILED_REG_BD_QUARTER = re.compile(REG_BD_QUARTER, re.U)
 COMPILED_REG_BD_QUARTER_EXTRA = re.compile(REG_BD_QUARTER_EXTRA, re.U)
 
 class Heti:
-    def __init__(self, html: str, rootSelector: str, builder: str = "lxml"):
+    def __init__(
+        self,
+        html: str,
+        rootSelector: str,
+        builder: str = "lxml",
+        protectedSelectors: Optional[List[str]] = None,
+        profile: Optional[dict] = None,
+        elements: Optional[HetiElements] = None,
+        memo: Optional[MatchMemo] = None,
+        compact: bool = False,
+    ):
+        self.elements = elements or HETI_ELEMENTS
+        self.memo = memo
+        self.compact = compact
+        # profile is filled with the time of each phase when given
+        self.profile = profile
+        if profile is not None:
+            start = time.perf_counter()
         self.soup = BeautifulSoup(html, builder)
+        if profile is not None:
+            profile["parse"] = time.perf_counter() - start
+            profile["protect"] = 0.0
+            profile["steps"] = [{"search": 0.0, "replace": 0.0, "matches": 0} for _ in range(HETI_STEPS)]
         self.rootSelector = rootSelector
+        if protectedSelectors is None:
+            protectedSelectors = HETI_PROTECTED_SELECTORS
+        self.protectedSelectors = protectedSelectors
         
     def funcForceContext(self, node: bs4.element.Tag) -> bool:
-        return node.name.lower() in HETI_NON_CONTIGUOUS_ELEMENTS
+        return self.elements.isForced(node.name)
     
     def funcFilterElement(self, node: bs4.element.Tag) -> bool:
-        if node.get("class"):
-            for c in node["class"]:
-                if c in HETI_SKIPPED_CLASS:
-                    return False
-        if node.name.lower() in HETI_SKIPPED_ELEMENTS:
-            return False
-        return True
+        return not self.elements.isSkipped(node.name, node.get("class"))
     
     def spacingElements(self, elmList: List[bs4.element.Tag]) -> None:
         for root in elmList:
             self.spacingElement(root)
     
-    def spacingElement(self, node: bs4.element.Tag, step: int) -> None:
+    def spacingElement(self, node: bs4.element.Tag, step: int, aggregation: Optional[TextAggregation] = None) -> Finder:
         commonConfig = {
             "forceContext": self.funcForceContext,
             "filterElements": self.funcFilterElement,
+            "aggregation": aggregation,
+            "memo": self.memo,
+            "profile": self.profile is not None,
         }
         
+        def setString(tag, text):
+            # an empty .string would leave an empty text node in the tree
+            if text:
+                tag.string = text
+
         def getWrapper(elementName, classList, text):
             r = self.soup.new_tag(elementName)
-            r["class"] = classList
-            r.string = text.strip()
+            r["class"] = [classList]
+            setString(r, text.strip())
             return r
         
         def spacingStart(text):
             s = self.soup.new_tag("span")
-            s["class"] = "heti-spacing"
+            s["class"] = ["heti-spacing"]
             s.string = " "
             r = self.soup.new_tag("span")
-            r.string = text.strip()
+            setString(r, text.strip())
             r.append(s)
             return r
         
         def spacingEnd(text):
             s = self.soup.new_tag("span")
-            s["class"] = "heti-spacing"
+            s["class"] = ["heti-spacing"]
             s.string = " "
             r = self.soup.new_tag("span")
-            r.string = text.strip()
+            setString(r, text.strip())
             r.insert(0, s)
             return r
         
+        def spacingCompact(classList, text):
+            r = self.soup.new_tag("span")
+            r["class"] = list(classList)
+            setString(r, text.strip())
+            return r
+
         def spacingStartEnd(text):
             s1 = self.soup.new_tag("span")
-            s1["class"] = "heti-spacing"
+            s1["class"] = ["heti-spacing"]
             s1.string = " "
             s2 = self.soup.new_tag("span")
-            s2["class"] = "heti-spacing"
+            s2["class"] = ["heti-spacing"]
             s2.string = " "
             r = self.soup.new_tag("span")
-            r["class"] = "heti-skip"
-            r.string = text.strip()
+            r["class"] = ["heti-skip"]
+            setString(r, text.strip())
             r.insert(0, s1)
             r.append(s2)
             return r
         
         # 西文左右包裹四分宽空格
         if step == 0:
-            Finder(self.soup, node, {
+            return Finder(self.soup, node, {
                 **commonConfig,
                 "find": COMPILED_REG_CJK_FULL,
-                "replace": lambda portion, _: spacingStartEnd(portion.text),
+                "prefilter": COMPILED_REG_CJK_CHARS,
+                "replace": lambda portion, _: (
+                    spacingCompact(HETI_COMPACT_START_END, portion.text) if self.compact
+                    else spacingStartEnd(portion.text)
+                ),
             })
 
         # 西文后附带四分宽空格
         if step == 1:
-            Finder(self.soup, node, {
+            return Finder(self.soup, node, {
                 **commonConfig,
                 "find": COMPILED_REG_CJK_START,
-                "replace": lambda portion, _: spacingStart(portion.text)
+                "prefilter": COMPILED_REG_CJK_CHARS,
+                "replace": lambda portion, _: (
+                    spacingCompact(HETI_COMPACT_START, portion.text) if self.compact
+                    else spacingStart(portion.text)
+                ),
             })
 
         # 西文前附带四分宽空格
         if step == 2:
-            Finder(self.soup, node, {
+            return Finder(self.soup, node, {
                 **commonConfig,
                 "find": COMPILED_REG_CJK_END,
-                "replace": lambda portion, _: spacingEnd(portion.text)
+                "prefilter": COMPILED_REG_CJK_CHARS,
+                "replace": lambda portion, _: (
+                    spacingCompact(HETI_COMPACT_END, portion.text) if self.compact
+                    else spacingEnd(portion.text)
+                ),
             })
 
         # 挤压连续标点至半宽
         if step == 3:
-            Finder(self.soup, node, {
+            return Finder(self.soup, node, {
                 **commonConfig,
                 "find": COMPILED_REG_BD_HALF,
+                "prefilter": COMPILED_REG_BD_CHARS,
                 "replace": lambda portion, _: getWrapper("heti-adjacent", "heti-adjacent-half", portion.text),
             })
 
         # 从分隔符中挤压掉四分宽
         if step == 4:
-            Finder(self.soup, node, {
+            return Finder(self.soup, node, {
                 **commonConfig,
                 "find": COMPILED_REG_BD_QUARTER,
+                "prefilter": COMPILED_REG_BD_CHARS,
                 "replace": lambda portion, _: getWrapper("heti-adjacent", "heti-adjacent-quarter", portion.text),
             })
 
         # original comment: 使用弯引号的情况下，在停顿符号接弯引号（如「。“」）或弯引号接全角开引号（如“《」）时，间距缩进调整到四分之一
         if step == 5:
-            Finder(self.soup, node, {
+            return Finder(self.soup, node, {
                 **commonConfig,
                 "find": COMPILED_REG_BD_QUARTER_EXTRA,
+                "prefilter": COMPILED_REG_BD_CHARS,
                 "replace": lambda portion, _: getWrapper("heti-adjacent", "heti-adjacent-quarter", portion.text),
             })
     
-    def spacing(self, n) -> str:
-        rootList = self.soup.find_all(self.rootSelector)
+    def protect(self, rootList: List[bs4.element.Tag]) -> List[bs4.element.Tag]:
+        # the protected elements are taken out of the tree, the placeholder
+        # still counts as western text so that it gets spaced like before
+        protected = []
+        if not self.protectedSelectors:
+            return protected
+        selector = ", ".join(self.protectedSelectors)
+        placeholders = []
+        for root in rootList:
+            for node in root.select(selector):
+                # nested in an element that is already protected
+                if not any(parent is root for parent in node.parents):
+                    continue
+                placeholder = self.soup.new_string(f"HETIprotectSTART{len(protected)}HETIprotectEND")
+                node.replace_with(placeholder)
+                protected.append(node)
+                placeholders.append(placeholder)
+        normalizeStrings(self.soup, placeholders)
+        return protected
+
+    def restore(self, rootList: List[bs4.element.Tag], protected: List[bs4.element.Tag]) -> None:
+        if not protected:
+            return
         for root in rootList:
-            self.spacingElement(root, n)
-        return str(self.soup)
-
-def heti(html: str, rootSelector: str) -> str:
-    for i in range(6):
-        _heti = Heti(html, rootSelector)
-        html = _heti.spacing(i)
-    return html
+            for string in root.find_all(string=REG_PROTECTED_PLACEHOLDER):
+                pos = 0
+                for match in REG_PROTECTED_PLACEHOLDER.finditer(string):
+                    if match.start() > pos:
+                        string.insert_before(self.soup.new_string(string[pos:match.start()]))
+                    string.insert_before(protected[int(match.group(1))])
+                    pos = match.end()
+                if pos < len(string):
+                    string.insert_before(self.soup.new_string(string[pos:]))
+                string.extract()
+
+    def spacing(self) -> str:
+        # every rule runs on the same tree, the rules are applied one after
+        # another to the whole root, so the document is parsed and serialized
+        # only once
+        profile = self.profile
+        # a CSS selector, as for the other engines
+        rootList = self.soup.select(self.rootSelector)
+        if profile is not None:
+            start = time.perf_counter()
+        protected = self.protect(rootList)
+        if profile is not None:
+            profile["protect"] += time.perf_counter() - start
+        # the text of each root is read once and kept up to date by the rules
+        aggregations = [
+            TextAggregation(root, self.funcFilterElement, self.funcForceContext)
+            for root in rootList
+        ]
+        # the rules never add characters, so a root without any CJK or
+        # punctuation to squeeze can skip the rules that need them
+        rootChars = []
+        for aggregation in aggregations:
+            text = "".join(aggregation.getText(i) for i in range(len(aggregation.contexts)))
+            rootChars.append({
+                "cjk": COMPILED_REG_CJK_CHARS.search(text) is not None,
+                "bd": COMPILED_REG_BD_CHARS.search(text) is not None,
+            })
+        # a root in another one is changed by the rules of both, its text is
+        # read again by every rule then
+        rootIds = {id(root) for root in rootList}
+        if any(id(parent) in rootIds for root in rootList for parent in root.parents):
+            aggregations = [None] * len(rootList)
+        newStrings = []
+        for step in range(HETI_STEPS):
+            replaced = normalizeStrings(self.soup, newStrings)
+            newStrings = []
+            for root, aggregation, chars in zip(rootList, aggregations, rootChars):
+                if aggregation:
+                    aggregation.normalize(replaced)
+                if chars[HETI_STEP_CHARS[step]]:
+                    finder = self.spacingElement(root, step, aggregation)
+                    newStrings.extend(finder.newStrings)
+                    if profile is not None:
+                        profile["steps"][step]["search"] += finder.searchTime
+                        profile["steps"][step]["replace"] += finder.replaceTime
+                        profile["steps"][step]["matches"] += len(finder.matches)
+        if profile is None:
+            self.restore(rootList, protected)
+            return str(self.soup)
+        start = time.perf_counter()
+        self.restore(rootList, protected)
+        profile["protect"] += time.perf_counter() - start
+        start = time.perf_counter()
+        html = str(self.soup)
+        profile["serialize"] = time.perf_counter() - start
+        return html
+
+def hasHetiChars(html: str) -> bool:
+    return not html.isascii() and COMPILED_REG_HETI_CHARS.search(html) is not None
+
+HETI_ENGINES = ["soup", "stream", "lxml"]
+# the element a fragment is put in to be typeset, see heti()
+HETI_FRAGMENT_ROOT = "heti-fragment"
+
+def heti(
+    html: str,
+    rootSelector: str,
+    protectedSelectors: Optional[List[str]] = None,
+    *,
+    engine: str = "soup",
+    profile: Optional[dict] = None,
+    elements: Optional[HetiElements] = None,
+    fragment: bool = False,
+    memo: Optional[MatchMemo] = None,
+    compact: bool = False,
+    largePageSize: int = 0,
+) -> str:
+    # no rule can match, e.g. a page in english only, so there is no need to parse it
+    if not hasHetiChars(html):
+        return html
+    if fragment:
+        # a fragment of a page, e.g. page.content, is typeset as a whole in
+        # an element of its own, rootSelector is not used
+        start = f"<{HETI_FRAGMENT_ROOT}>"
+        end = f"</{HETI_FRAGMENT_ROOT}>"
+        html = heti(
+            f"{start}{html}{end}", HETI_FRAGMENT_ROOT, protectedSelectors,
+            engine=engine, profile=profile, elements=elements, memo=memo, compact=compact, largePageSize=largePageSize,
+        )
+        return html[html.index(start) + len(start):html.rindex(end)]
+    if largePageSize and engine == "soup" and len(html) > largePageSize:
+        # the soup of a page takes many times its size, a large page is
+        # typeset a block at a time, see HetiBlocks; the other engines never
+        # hold more than the lxml tree
+        from .blocks import HetiBlocks
+        return HetiBlocks(
+            html, rootSelector, protectedSelectors, engine=engine, elements=elements, memo=memo, compact=compact,
+        ).spacing()
+    if engine == "stream":
+        # imported here, the stream engine uses the rules defined above
+        from .stream import hetiStream
+        return "".join(hetiStream([html], rootSelector, protectedSelectors, elements=elements, memo=memo, compact=compact))
+    if engine == "lxml":
+        from .tree import HetiTree
+        return HetiTree(html, rootSelector, protectedSelectors, elements=elements, memo=memo, compact=compact).spacing()
+    if engine != "soup":
+        raise ValueError(f"unknown engine: {engine!r}")
+    # only the soup engine reports its phases in profile
+    return Heti(html, rootSelector, protectedSelectors=protectedSelectors, profile=profile, elements=elements, memo=memo, compact=compact).spacing()
     
 
 if __name__ == "__main__":
@@ -0,0 +1,113 @@
+"""
+Typesetting of whole pages, as the plugin and heti_batch do it, in the
+current process or in a pool of workers. Nothing here depends on MkDocs.
+"""
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from .finder import MatchMemo
+from .heti import HETI_ELEMENTS, HETI_PROTECTED_SELECTORS, HetiElements, heti
+from .profile import maxRss
+from .protect import Protector, compilePatterns
+
+class HetiOptions:
+    """
+    The options of heti_page that are the same for every page of a build:
+    made once from the config and sent to the workers along with the pages.
+    Raises ValueError for a wrong protected pattern.
+    """
+
+    def __init__(
+        self,
+        root_selector: str = "article",
+        protected_selectors: Optional[List[str]] = None,
+        protected_patterns: Optional[List[Tuple[str, str]]] = None,
+        engine: str = "soup",
+        elements: Optional[HetiElements] = None,
+        fragment: bool = False,
+        compact: bool = False,
+        large_page_size: int = 0,
+    ):
+        self.root_selector = root_selector
+        self.protected_selectors = list(HETI_PROTECTED_SELECTORS if protected_selectors is None else protected_selectors)
+        self.protected_patterns = list(protected_patterns or [])
+        self.protected_regexes = compilePatterns(self.protected_patterns)
+        self.engine = engine
+        self.elements = elements or HETI_ELEMENTS
+        self.fragment = fragment
+        self.compact = compact
+        # in characters
+        self.large_page_size = large_page_size
+
+    def __repr__(self) -> str:
+        # this is part of the keys of the cache
+        return (
+            f"HetiOptions(root_selector={self.root_selector!r}, "
+            f"protected_selectors={self.protected_selectors!r}, "
+            f"protected_patterns={self.protected_patterns!r}, engine={self.engine!r}, "
+            f"elements={self.elements!r}, fragment={self.fragment!r}, compact={self.compact!r}, "
+            f"large_page_size={self.large_page_size!r})"
+        )
+
+def heti_page(
+    output: str,
+    options: HetiOptions,
+    memo: Optional[MatchMemo] = None,
+    profile: Optional[dict] = None,
+) -> str:
+    # <kbd>, .arithmatex and the other protected_selectors are protected by
+    # heti itself, extra_protected_patterns are replaced by placeholders like
+    # HETIextraSTART0HETIextraEND and put back after heti's processing
+    start = time.perf_counter()
+    protector = Protector(options.protected_regexes)
+    protected = protector.protect(output)
+    protect = time.perf_counter() - start
+    html = heti(
+        protected,
+        options.root_selector,
+        options.protected_selectors,
+        engine=options.engine,
+        profile=profile,
+        elements=options.elements,
+        fragment=options.fragment,
+        memo=memo,
+        compact=options.compact,
+        largePageSize=options.large_page_size,
+    )
+    restore = time.perf_counter()
+    html = protector.restore(html)
+    if profile is not None:
+        end = time.perf_counter()
+        profile["protect"] = profile.get("protect", 0.0) + protect + end - restore
+        profile["total"] = end - start
+        profile["max_rss"] = maxRss()
+    return html
+
+HETI_EXECUTORS = ["process", "thread"]
+
+# the match memo of a worker, made by init_worker: one per worker process, or
+# per thread of a thread pool since a MatchMemo is not thread-safe
+worker_state = threading.local()
+
+def init_worker(memo_size: int) -> None:
+    worker_state.memo = MatchMemo(memo_size) if memo_size > 0 else None
+
+def heti_page_worker(output: str, options: HetiOptions, profile: bool = False) -> Tuple[str, Optional[dict], int, int]:
+    # heti_page for the workers, which send back the profile and the hits and
+    # misses of their match memo
+    memo = getattr(worker_state, "memo", None)
+    hits, misses = (memo.hits, memo.misses) if memo else (0, 0)
+    page_profile = {} if profile else None
+    html = heti_page(output, options, memo=memo, profile=page_profile)
+    if memo:
+        hits, misses = memo.hits - hits, memo.misses - misses
+    return html, page_profile, hits, misses
+
+def worker_pool(executor: str, workers: int, memo_size: int) -> Executor:
+    # threads need no pickling of the pages and share the config, but only
+    # typeset in parallel on a free-threaded Python (3.13t and later)
+    if executor == "thread":
+        return ThreadPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(memo_size,))
+    return ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(memo_size,))
@@ -0,0 +1,85 @@
+import csv
+import json
+import os
+import sys
+from typing import List, Optional
+
+try:
+    import resource
+except ImportError:
+    # not on Windows
+    resource = None
+
+from .heti import HETI_STEPS
+
+# phases of a page's profile, as filled by heti_page and Heti
+PROFILE_PHASES = ["parse", "protect", "search", "replace", "serialize"]
+
+def maxRss() -> Optional[int]:
+    # the peak resident set size of the process so far, in KB
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # in bytes on macOS
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+def pageTimes(profile: dict) -> dict:
+    times = {phase: profile.get(phase, 0.0) for phase in ("parse", "protect", "serialize")}
+    steps = profile.get("steps", [])
+    times["search"] = sum(step["search"] for step in steps)
+    times["replace"] = sum(step["replace"] for step in steps)
+    return times
+
+def summarize(profiles: List[dict], top: int) -> List[str]:
+    lines = []
+    total = sum(profile["total"] for profile in profiles)
+    lines.append(f"heti: typeset {len(profiles)} page(s) in {total:.2f}s")
+    phases = {phase: 0.0 for phase in PROFILE_PHASES}
+    steps = [{"search": 0.0, "replace": 0.0, "matches": 0} for _ in range(HETI_STEPS)]
+    for profile in profiles:
+        for phase, value in pageTimes(profile).items():
+            phases[phase] += value
+        for step, values in enumerate(profile.get("steps", [])):
+            for key in values:
+                steps[step][key] += values[key]
+    lines.append("  " + ", ".join(f"{phase} {value:.2f}s" for phase, value in phases.items()))
+    for step, values in enumerate(steps):
+        lines.append(
+            f"  step {step}: search {values['search']:.2f}s, "
+            f"replace {values['replace']:.2f}s, {values['matches']} match(es)"
+        )
+    peaks = [profile for profile in profiles if profile.get("max_rss")]
+    if peaks:
+        # the peak of a process only grows, the page that reached it is the
+        # first one with the highest value
+        peak = max(peaks, key=lambda profile: profile["max_rss"])
+        lines.append(f"  process peak RSS {peak['max_rss'] / 1024:.0f} MB, reached on {peak['page']}")
+    lines.append("  slowest pages:")
+    for profile in sorted(profiles, key=lambda profile: profile["total"], reverse=True)[:top]:
+        times = pageTimes(profile)
+        lines.append(
+            f"  {profile['total']:8.3f}s  {profile['page']}  ("
+            + ", ".join(f"{phase} {value:.3f}s" for phase, value in times.items())
+            + ")"
+        )
+    return lines
+
+def writeReport(profiles: List[dict], path: str) -> None:
+    # a .csv path gets one row per page, anything else the profiles as JSON
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if not path.endswith(".csv"):
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(profiles, file, indent=2, ensure_ascii=False)
+        return
+    header = ["page", "total", "max_rss", "parse", "protect", "serialize"]
+    for step in range(HETI_STEPS):
+        header += [f"step{step}_search", f"step{step}_replace", f"step{step}_matches"]
+    with open(path, "w", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        for profile in profiles:
+            row = [profile["page"], profile["total"], profile.get("max_rss", "")] + [profile.get(phase, "") for phase in ("parse", "protect", "serialize")]
+            steps = profile.get("steps") or [{}] * HETI_STEPS
+            for step in steps:
+                row += [step.get("search", ""), step.get("replace", ""), step.get("matches", "")]
+            writer.writerow(row)
@@ -0,0 +1,54 @@
+import re
+from typing import Dict, List, Pattern, Tuple
+
+# (name, pattern) of the regions that are replaced by placeholders like
+# HETIextraSTART0HETIextraEND before heti's processing and put back afterwards,
+# elements that can be matched by a CSS selector are better protected with
+# HETI_PROTECTED_SELECTORS which works on the parsed tree
+HETI_PROTECTED_PATTERNS = []
+
+REG_PLACEHOLDER = re.compile(r"HETI([a-z]+)START(\d+)HETI\1END")
+
+def compilePatterns(patterns: List[Tuple[str, str]]) -> List[Tuple[str, Pattern]]:
+    # once for all the pages, so that a wrong pattern is reported with the
+    # config instead of by the first page
+    compiled = []
+    for name, pattern in patterns:
+        if not re.fullmatch(r"[a-z]+", name):
+            raise ValueError(f"invalid protected pattern name: {name!r}")
+        try:
+            compiled.append((name, re.compile(pattern)))
+        except re.error as e:
+            raise ValueError(f"invalid protected pattern {pattern!r}: {e}") from e
+    return compiled
+
+class Protector:
+    def __init__(self, patterns: List[Tuple[str, Pattern]]):
+        # patterns as given by compilePatterns
+        self.patterns = patterns
+        self.contents: Dict[str, List[str]] = dict()
+
+    def protect(self, html: str) -> str:
+        for name, regex in self.patterns:
+            contents = self.contents.setdefault(name, [])
+
+            def placeholder(match):
+                contents.append(match.group(0))
+                return f"HETI{name}START{len(contents) - 1}HETI{name}END"
+
+            html = regex.sub(placeholder, html)
+        return html
+
+    def restore(self, html: str) -> str:
+        if not any(self.contents.values()):
+            return html
+
+        def original(match):
+            contents = self.contents.get(match.group(1))
+            index = int(match.group(2))
+            if contents is None or index >= len(contents):
+                return match.group(0)
+            # a protected region may contain the placeholders of another one
+            return REG_PLACEHOLDER.sub(original, contents[index])
+
+        return REG_PLACEHOLDER.sub(original, html)
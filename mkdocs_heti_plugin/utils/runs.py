@@ -0,0 +1,196 @@
+from typing import List, NamedTuple, Optional
+
+from .finder import ASCII_SPACES, MatchMemo, searchSpans
+from .heti import (
+    COMPILED_REG_BD_CHARS,
+    COMPILED_REG_BD_HALF,
+    COMPILED_REG_BD_QUARTER,
+    COMPILED_REG_BD_QUARTER_EXTRA,
+    COMPILED_REG_CJK_CHARS,
+    COMPILED_REG_CJK_END,
+    COMPILED_REG_CJK_FULL,
+    COMPILED_REG_CJK_START,
+    HETI_COMPACT_END,
+    HETI_COMPACT_START,
+    HETI_COMPACT_START_END,
+)
+
+# The rules of Heti.spacingElement applied to a single text run (a context of
+# Finder.getAggregateText) without any DOM. A run is a flat list of entries in
+# document order: Text for the text nodes, Open / Close for the tags created
+# by the rules, and any other object for the markup of the engine, which is
+# passed through untouched.
+
+class Text:
+    __slots__ = ("text", "raw", "skip")
+
+    def __init__(self, text: str, raw: Optional[str] = None, skip: bool = False):
+        self.text = text
+        # the source of the text if it is unchanged, for the engine to reuse
+        self.raw = raw
+        # text in a heti-skip wrapper, which is not matched anymore
+        self.skip = skip
+
+    def __repr__(self) -> str:
+        return f"Text({self.text!r})"
+
+
+class Open(NamedTuple):
+    name: str
+    classList: Optional[List[str]] = None
+
+
+class Close(NamedTuple):
+    name: str
+
+
+def wrapperText(text: str, skip: bool = False) -> list:
+    text = text.strip()
+    return [Text(text, skip=skip)] if text else []
+
+def spacing(skip: bool = False) -> list:
+    return [Open("span", ["heti-spacing"]), Text(" ", skip=skip), Close("span")]
+
+def spacingStart(text: str) -> list:
+    return [Open("span"), *wrapperText(text), *spacing(), Close("span")]
+
+def spacingEnd(text: str) -> list:
+    return [Open("span"), *spacing(), *wrapperText(text), Close("span")]
+
+def spacingStartEnd(text: str) -> list:
+    return [
+        Open("span", ["heti-skip"]),
+        *spacing(skip=True),
+        *wrapperText(text, skip=True),
+        *spacing(skip=True),
+        Close("span"),
+    ]
+
+def adjacent(classList: str):
+    def wrapper(text: str) -> list:
+        return [Open("heti-adjacent", [classList]), *wrapperText(text), Close("heti-adjacent")]
+    return wrapper
+
+def compactSpacing(classList: List[str], skip: bool = False):
+    # a single span, the margins of the heti-spacing-* classes stand for the
+    # spaces
+    def wrapper(text: str) -> list:
+        return [Open("span", classList), *wrapperText(text, skip=skip), Close("span")]
+    return wrapper
+
+# (find, prefilter, replace) in the order of Heti.spacingElement's steps
+RUN_STEPS = [
+    (COMPILED_REG_CJK_FULL, COMPILED_REG_CJK_CHARS, spacingStartEnd),
+    (COMPILED_REG_CJK_START, COMPILED_REG_CJK_CHARS, spacingStart),
+    (COMPILED_REG_CJK_END, COMPILED_REG_CJK_CHARS, spacingEnd),
+    (COMPILED_REG_BD_HALF, COMPILED_REG_BD_CHARS, adjacent("heti-adjacent-half")),
+    (COMPILED_REG_BD_QUARTER, COMPILED_REG_BD_CHARS, adjacent("heti-adjacent-quarter")),
+    (COMPILED_REG_BD_QUARTER_EXTRA, COMPILED_REG_BD_CHARS, adjacent("heti-adjacent-quarter")),
+]
+COMPACT_RUN_STEPS = [
+    (COMPILED_REG_CJK_FULL, COMPILED_REG_CJK_CHARS, compactSpacing(HETI_COMPACT_START_END, skip=True)),
+    (COMPILED_REG_CJK_START, COMPILED_REG_CJK_CHARS, compactSpacing(HETI_COMPACT_START)),
+    (COMPILED_REG_CJK_END, COMPILED_REG_CJK_CHARS, compactSpacing(HETI_COMPACT_END)),
+    *RUN_STEPS[3:],
+]
+
+
+def collapseText(text: str) -> Optional[str]:
+    # BeautifulSoup turns a whitespace-only string into a single space or newline
+    if text and not text.strip(ASCII_SPACES):
+        collapsed = "\n" if "\n" in text else " "
+        if collapsed != text:
+            return collapsed
+    return None
+
+def normalizeRun(entries: list) -> list:
+    # same as finder.normalizeStrings: merge adjacent texts, drop empty ones
+    # and collapse the whitespace-only ones
+    result = []
+    for entry in entries:
+        if type(entry) is Text and result and type(result[-1]) is Text and result[-1].skip == entry.skip:
+            last = result[-1]
+            result[-1] = Text(last.text + entry.text, skip=last.skip)
+        else:
+            result.append(entry)
+    normalized = []
+    for entry in result:
+        if type(entry) is Text:
+            if not entry.text:
+                continue
+            collapsed = collapseText(entry.text)
+            if collapsed is not None:
+                entry = Text(collapsed, skip=entry.skip)
+        normalized.append(entry)
+    return normalized
+
+def portionReplacement(replace, text: str) -> list:
+    if text == " ":
+        return [Text("")]
+    return replace(text)
+
+def applyMatches(entries: list, matches: list, replace) -> list:
+    # one ordered sweep, splitting the text nodes the same way as
+    # Finder.processMatches and Finder.replaceMatch do
+    result = []
+    matchIndex = 0
+    inMatch = False
+    atIndex = 0
+    for entry in entries:
+        if type(entry) is not Text or entry.skip:
+            result.append(entry)
+            continue
+        node = entry
+        text = entry.text
+        nodeIndex = atIndex
+        atIndex += len(text)
+        while True:
+            if matchIndex >= len(matches):
+                result.append(node)
+                break
+            start, end = matches[matchIndex]
+            nodeEnd = nodeIndex + len(text)
+            if not inMatch:
+                if nodeEnd <= start:
+                    result.append(node)
+                    break
+                if nodeEnd >= end:
+                    # the whole match is in this node
+                    if start > nodeIndex:
+                        result.append(Text(text[:start - nodeIndex]))
+                    result.extend(portionReplacement(replace, text[start - nodeIndex:end - nodeIndex]))
+                    matchIndex += 1
+                    if end >= nodeEnd:
+                        break
+                    text = text[end - nodeIndex:]
+                    node = Text(text)
+                    nodeIndex = end
+                    continue
+                result.append(Text(text[:start - nodeIndex]))
+                result.extend(portionReplacement(replace, text[start - nodeIndex:]))
+                inMatch = True
+                break
+            if nodeEnd >= end:
+                # the last node of a match across nodes
+                result.extend(portionReplacement(replace, text[:end - nodeIndex]))
+                inMatch = False
+                matchIndex += 1
+                text = text[end - nodeIndex:]
+                node = Text(text)
+                nodeIndex = end
+                continue
+            result.extend(portionReplacement(replace, text))
+            break
+    return result
+
+def spacingRun(entries: list, memo: Optional[MatchMemo] = None, compact: bool = False) -> list:
+    for step, (find, prefilter, replace) in enumerate(COMPACT_RUN_STEPS if compact else RUN_STEPS):
+        if step:
+            entries = normalizeRun(entries)
+        text = "".join(entry.text for entry in entries if type(entry) is Text and not entry.skip)
+        if not prefilter.search(text):
+            continue
+        matches = memo.search(find, text) if memo else searchSpans(find, text)
+        if matches:
+            entries = applyMatches(entries, matches, replace)
+    return entries
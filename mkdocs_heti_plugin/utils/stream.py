@@ -0,0 +1,335 @@
+import re
+from html import escape, unescape
+from html.parser import HTMLParser
+from typing import Iterable, Iterator, List, Optional
+
+from .finder import MatchMemo
+from .heti import (
+    HETI_ELEMENTS,
+    HETI_PROTECTED_SELECTORS,
+    REG_PROTECTED_PLACEHOLDER,
+    HetiElements,
+)
+from .runs import Close, Open, Text, collapseText, spacingRun
+
+# elements without an end tag
+VOID_ELEMENTS = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta",
+    "param", "source", "track", "wbr",
+}
+
+REG_SIMPLE_SELECTOR = re.compile(r"([a-zA-Z][\w-]*)?((?:[.#][\w-]+)*)")
+
+def parseSelectors(selectors: List[str]) -> list:
+    # only compound selectors like kbd, .arithmatex or span.arithmatex#id are
+    # supported, there is no tree to run combinators on
+    parsed = []
+    for selector in selectors:
+        for part in selector.split(","):
+            part = part.strip()
+            match = REG_SIMPLE_SELECTOR.fullmatch(part)
+            if not part or not match:
+                raise ValueError(f"selector not supported by the stream engine: {part!r}")
+            name = match.group(1).lower() if match.group(1) else None
+            classes = re.findall(r"\.([\w-]+)", match.group(2))
+            ids = re.findall(r"#([\w-]+)", match.group(2))
+            parsed.append((name, set(classes), ids[0] if ids else None))
+    return parsed
+
+def matchesSelectors(selectors: list, name: str, attrs: list) -> bool:
+    # whether an element matches one of the selectors of parseSelectors
+    classes = set()
+    elementId = None
+    for attr, value in attrs:
+        if attr == "class" and value:
+            classes.update(value.split())
+        elif attr == "id":
+            elementId = value
+    for selectorName, selectorClasses, selectorId in selectors:
+        if selectorName and selectorName != name:
+            continue
+        if selectorId and selectorId != elementId:
+            continue
+        if selectorClasses <= classes:
+            return True
+    return False
+
+def renderRun(entries: list, protected: List[str]) -> str:
+    out = []
+    for entry in entries:
+        if type(entry) is Text:
+            out.append(entry.raw if entry.raw is not None else escape(entry.text, quote=False))
+        elif type(entry) is Open:
+            if entry.classList:
+                out.append(f'<{entry.name} class="{" ".join(entry.classList)}">')
+            else:
+                out.append(f"<{entry.name}>")
+        elif type(entry) is Close:
+            out.append(f"</{entry.name}>")
+        else:
+            out.append(entry)
+    html = "".join(out)
+    if protected:
+        html = REG_PROTECTED_PLACEHOLDER.sub(lambda match: protected[int(match.group(1))], html)
+    return html
+
+
+class Element:
+    __slots__ = ("name", "forced", "breaks")
+
+    def __init__(self, name: str, forced: bool, breaks: int):
+        self.name = name
+        self.forced = forced
+        # number of context breaks when the element was opened
+        self.breaks = breaks
+
+
+class HetiStream(HTMLParser):
+    """
+    Streaming engine: the page goes through an HTML tokenizer, without a
+    tree. The runs are the same as the contexts of Finder.getAggregateText,
+    and get the same rules through spacingRun. The markup outside of changed
+    text is written out as it came in. The output is kept until take(), and
+    heti() feeds the whole page at once, so the memory used still grows with
+    the page.
+
+    Differences with the soup engine: the root and protected selectors can
+    only be compound selectors and a root nested in another one is only
+    processed once, the text of comments is not matched, and
+    the HTML is not fixed up the way lxml does for broken markup.
+    """
+
+    def __init__(
+        self,
+        rootSelector: str,
+        protectedSelectors: Optional[List[str]] = None,
+        *,
+        elements: Optional[HetiElements] = None,
+        memo: Optional[MatchMemo] = None,
+        compact: bool = False,
+    ):
+        super().__init__(convert_charrefs=False)
+        self.elements = elements or HETI_ELEMENTS
+        self.memo = memo
+        self.compact = compact
+        self.rootSelectors = parseSelectors([rootSelector])
+        if protectedSelectors is None:
+            protectedSelectors = HETI_PROTECTED_SELECTORS
+        self.protectedSelectors = parseSelectors(protectedSelectors)
+        self.out = []
+        # open elements in the root, the root being the first one
+        self.stack: List[Element] = []
+        # depth in the stack of the skipped / protected element we are in
+        self.skippedDepth = None
+        self.protectedDepth = None
+        self.protectedMarkup = []
+        self.protected = []
+        # the current text run, and the text node being read
+        self.run = []
+        self.textParts = []
+        self.rawParts = []
+        self.breaks = 0
+
+    # -- output
+
+    def emit(self, markup: str) -> None:
+        if self.protectedDepth is not None:
+            self.protectedMarkup.append(markup)
+        elif self.stack:
+            self.endText()
+            self.run.append(markup)
+        else:
+            self.out.append(markup)
+
+    def endText(self) -> None:
+        if not self.textParts:
+            return
+        text = "".join(self.textParts)
+        # the source of a protected element is not the placeholder's
+        raw = None if None in self.rawParts else "".join(self.rawParts)
+        self.textParts = []
+        self.rawParts = []
+        if self.run and type(self.run[-1]) is Text:
+            # a protected element was put in as text right before
+            last = self.run.pop()
+            text = last.text + text
+            raw = None
+        collapsed = collapseText(text)
+        if collapsed is not None:
+            text, raw = collapsed, None
+        self.run.append(Text(text, raw))
+
+    def breakRun(self) -> None:
+        self.endText()
+        if self.run:
+            self.out.append(renderRun(spacingRun(self.run, self.memo, self.compact), self.protected))
+            self.run = []
+            self.protected = []
+        self.breaks += 1
+
+    def take(self) -> str:
+        out = "".join(self.out)
+        self.out = []
+        return out
+
+    # -- elements
+
+    def isProtected(self, name: str, attrs: list) -> bool:
+        return bool(self.protectedSelectors) and matchesSelectors(self.protectedSelectors, name, attrs)
+
+    def isSkipped(self, name: str, attrs: list) -> bool:
+        for attr, value in attrs:
+            if attr == "class" and value:
+                return self.elements.isSkipped(name, value.split())
+        return self.elements.isSkipped(name)
+
+    def openElement(self, name: str, attrs: list, markup: str) -> None:
+        if self.protectedDepth is not None or self.skippedDepth is not None:
+            self.emit(markup)
+            self.stack.append(Element(name, False, self.breaks))
+            return
+        if not self.stack:
+            if not matchesSelectors(self.rootSelectors, name, attrs):
+                self.out.append(markup)
+                return
+            self.out.append(markup)
+            if self.isSkipped(name, attrs):
+                # a skipped root is left as it is, as by the other engines
+                self.skippedDepth = 0
+            self.stack.append(Element(name, True, self.breaks))
+            return
+        forced = self.elements.isForced(name)
+        if self.isProtected(name, attrs):
+            self.endText()
+            self.protectedDepth = len(self.stack)
+            self.protectedMarkup = [markup]
+            self.stack.append(Element(name, False, self.breaks))
+            return
+        if self.isSkipped(name, attrs):
+            if forced:
+                self.breakRun()
+            self.skippedDepth = len(self.stack)
+            self.emit(markup)
+            self.stack.append(Element(name, forced, self.breaks))
+            return
+        if forced:
+            self.breakRun()
+            self.out.append(markup)
+        else:
+            self.emit(markup)
+        self.stack.append(Element(name, forced, self.breaks))
+
+    def closeElement(self, markup: str) -> None:
+        element = self.stack.pop()
+        depth = len(self.stack)
+        if self.protectedDepth is not None:
+            self.protectedMarkup.append(markup)
+            if depth == self.protectedDepth:
+                self.protectedDepth = None
+                # the placeholder is merged with the text around it
+                self.textParts.append(f"HETIprotectSTART{len(self.protected)}HETIprotectEND")
+                self.rawParts.append(None)
+                self.protected.append("".join(self.protectedMarkup))
+                self.protectedMarkup = []
+            return
+        if self.skippedDepth is not None and not self.stack:
+            # the end of a skipped root
+            self.skippedDepth = None
+            self.breakRun()
+            self.out.append(markup)
+            return
+        if self.skippedDepth is not None:
+            self.emit(markup)
+            if depth == self.skippedDepth:
+                self.skippedDepth = None
+                if element.forced:
+                    self.breakRun()
+            return
+        if not self.stack or element.forced:
+            self.breakRun()
+            self.out.append(markup)
+            return
+        self.emit(markup)
+        if self.breaks != element.breaks:
+            self.breakRun()
+
+    # -- HTMLParser
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        markup = self.get_starttag_text()
+        self.openElement(tag, attrs, markup)
+        if tag in VOID_ELEMENTS and self.stack and self.stack[-1].name == tag:
+            self.closeElement("")
+
+    def handle_startendtag(self, tag: str, attrs: list) -> None:
+        markup = self.get_starttag_text()
+        self.openElement(tag, attrs, markup)
+        if self.stack and self.stack[-1].name == tag:
+            self.closeElement("")
+
+    def handle_endtag(self, tag: str) -> None:
+        markup = f"</{tag}>"
+        if tag in VOID_ELEMENTS or not any(element.name == tag for element in self.stack):
+            self.emit(markup)
+            return
+        while self.stack[-1].name != tag:
+            self.closeElement("")
+        self.closeElement(markup)
+
+    def handle_data(self, data: str) -> None:
+        if self.stack and self.protectedDepth is None and self.skippedDepth is None:
+            self.textParts.append(data)
+            self.rawParts.append(data)
+        else:
+            self.emit(data)
+
+    def handle_entityref(self, name: str) -> None:
+        self.handleReference(f"&{name};")
+
+    def handle_charref(self, name: str) -> None:
+        self.handleReference(f"&#{name};")
+
+    def handleReference(self, raw: str) -> None:
+        if self.stack and self.protectedDepth is None and self.skippedDepth is None:
+            self.textParts.append(unescape(raw))
+            self.rawParts.append(raw)
+        else:
+            self.emit(raw)
+
+    def handle_comment(self, data: str) -> None:
+        self.emit(f"<!--{data}-->")
+
+    def handle_decl(self, decl: str) -> None:
+        self.emit(f"<!{decl}>")
+
+    def handle_pi(self, data: str) -> None:
+        self.emit(f"<?{data}>")
+
+    def unknown_decl(self, data: str) -> None:
+        self.emit(f"<![{data}]>")
+
+    def close(self) -> None:
+        super().close()
+        while self.stack:
+            self.closeElement("")
+
+
+def hetiStream(
+    chunks: Iterable[str],
+    rootSelector: str,
+    protectedSelectors: Optional[List[str]] = None,
+    *,
+    elements: Optional[HetiElements] = None,
+    memo: Optional[MatchMemo] = None,
+    compact: bool = False,
+) -> Iterator[str]:
+    parser = HetiStream(rootSelector, protectedSelectors, elements=elements, memo=memo, compact=compact)
+    for chunk in chunks:
+        parser.feed(chunk)
+        out = parser.take()
+        if out:
+            yield out
+    parser.close()
+    out = parser.take()
+    if out:
+        yield out
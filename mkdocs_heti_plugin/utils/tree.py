@@ -0,0 +1,248 @@
+from typing import List, Optional
+
+import lxml.html
+from lxml import etree
+from lxml.cssselect import CSSSelector
+
+from .finder import MatchMemo
+from .heti import (
+    HETI_ELEMENTS,
+    HETI_PROTECTED_SELECTORS,
+    REG_PROTECTED_PLACEHOLDER,
+    HetiElements,
+)
+from .runs import Close, Open, Text, collapseText, spacingRun
+
+class Slot:
+    # the .text or .tail of an element, the text entries of a run that follow
+    # a slot are written back to it
+    __slots__ = ("element", "tail")
+
+    def __init__(self, element: etree.ElementBase, tail: bool):
+        self.element = element
+        self.tail = tail
+
+
+def getSlot(element: etree.ElementBase, tail: bool) -> str:
+    return (element.tail if tail else element.text) or ""
+
+def setSlot(element: etree.ElementBase, tail: bool, text: str) -> None:
+    if tail:
+        element.tail = text or None
+    else:
+        element.text = text or None
+
+def insertSlot(element: etree.ElementBase, tail: bool, text: str, children: list) -> None:
+    setSlot(element, tail, text)
+    if not children:
+        return
+    if tail:
+        parent = element.getparent()
+        index = parent.index(element) + 1
+    else:
+        parent = element
+        index = 0
+    for child in children:
+        parent.insert(index, child)
+        index += 1
+
+def buildSlot(makeelement, entries: list):
+    # the text before the first new element, and the new elements with their tails
+    text = []
+    children = []
+    stack = []
+    for entry in entries:
+        if type(entry) is Text:
+            if not entry.text:
+                continue
+            if stack:
+                parent = stack[-1]
+                if len(parent):
+                    parent[-1].tail = (parent[-1].tail or "") + entry.text
+                else:
+                    parent.text = (parent.text or "") + entry.text
+            elif children:
+                children[-1].tail = (children[-1].tail or "") + entry.text
+            else:
+                text.append(entry.text)
+        elif type(entry) is Open:
+            element = makeelement(entry.name, {"class": " ".join(entry.classList)} if entry.classList else {})
+            if stack:
+                stack[-1].append(element)
+            else:
+                children.append(element)
+            stack.append(element)
+        elif type(entry) is Close:
+            stack.pop()
+    return "".join(text), children
+
+
+class HetiTree:
+    """
+    lxml engine: the rules of runs.py applied to the text runs of an lxml.html
+    tree, the changes are spliced into the .text and .tail of the elements.
+    The runs are the contexts of Finder.getAggregateText, so the output is the
+    same as the soup engine's, except that the text of comments is not matched
+    and a root nested in another one is only processed once.
+    """
+
+    def __init__(
+        self,
+        html: str,
+        rootSelector: str,
+        protectedSelectors: Optional[List[str]] = None,
+        *,
+        elements: Optional[HetiElements] = None,
+        memo: Optional[MatchMemo] = None,
+        compact: bool = False,
+    ):
+        self.elements = elements or HETI_ELEMENTS
+        self.memo = memo
+        self.compact = compact
+        self.tree = lxml.html.document_fromstring(html).getroottree()
+        # lxml adds a doctype to a document without one
+        self.doctype = html.lstrip()[:9].lower() == "<!doctype"
+        # and drops the whitespace after </html>
+        self.trailing = html[len(html.rstrip()):]
+        self.rootSelector = CSSSelector(rootSelector)
+        if protectedSelectors is None:
+            protectedSelectors = HETI_PROTECTED_SELECTORS
+        self.protectedSelector = CSSSelector(", ".join(protectedSelectors)) if protectedSelectors else None
+        self.makeelement = self.tree.getroot().makeelement
+
+    def isForced(self, element: etree.ElementBase) -> bool:
+        return self.elements.isForced(element.tag)
+
+    def isFiltered(self, element: etree.ElementBase) -> bool:
+        if not isinstance(element.tag, str):
+            # comments and processing instructions
+            return True
+        classList = element.get("class")
+        return self.elements.isSkipped(element.tag, classList.split() if classList else None)
+
+    def collapse(self, element: etree.ElementBase) -> None:
+        # BeautifulSoup turns whitespace-only strings into a single space or
+        # newline when parsing, the soup engine matches the text like that
+        if element.text:
+            collapsed = collapseText(element.text)
+            if collapsed is not None:
+                element.text = collapsed
+        for child in element:
+            if not self.isFiltered(child):
+                self.collapse(child)
+            if child.tail:
+                collapsed = collapseText(child.tail)
+                if collapsed is not None:
+                    child.tail = collapsed
+
+    def protect(self, root: etree.ElementBase, protected: list) -> None:
+        if self.protectedSelector is None:
+            return
+        for element in self.protectedSelector(root):
+            # nested in an element that is already protected
+            if not any(parent is root for parent in element.iterancestors()):
+                continue
+            text = f"HETIprotectSTART{len(protected)}HETIprotectEND" + (element.tail or "")
+            element.tail = None
+            previous = element.getprevious()
+            parent = element.getparent()
+            if previous is not None:
+                previous.tail = (previous.tail or "") + text
+            else:
+                parent.text = (parent.text or "") + text
+            parent.remove(element)
+            protected.append(element)
+
+    def restore(self, root: etree.ElementBase, protected: list) -> None:
+        if not protected:
+            return
+        slots = []
+        for element in root.iter():
+            if isinstance(element.tag, str) and element.text and "HETIprotect" in element.text:
+                slots.append((element, False))
+            if element is not root and element.tail and "HETIprotect" in element.tail:
+                slots.append((element, True))
+        for element, tail in slots:
+            string = getSlot(element, tail)
+            pieces = REG_PROTECTED_PLACEHOLDER.split(string)
+            children = []
+            for i in range(1, len(pieces), 2):
+                child = protected[int(pieces[i])]
+                child.tail = pieces[i + 1] or None
+                children.append(child)
+            insertSlot(element, tail, pieces[0], children)
+
+    def runs(self, root: etree.ElementBase):
+        # same contexts as Finder.getAggregateText: a new run starts around
+        # the non contiguous elements, and after an element containing one
+        run = []
+        breaks = 0
+
+        def walk(element):
+            nonlocal run, breaks
+            run.append(Slot(element, False))
+            if element.text:
+                run.append(Text(element.text))
+            for child in element:
+                forced = isinstance(child.tag, str) and self.isForced(child)
+                if forced:
+                    yield run
+                    run = []
+                    breaks += 1
+                if not self.isFiltered(child):
+                    before = breaks
+                    yield from walk(child)
+                    if not forced and breaks != before:
+                        yield run
+                        run = []
+                        breaks += 1
+                if forced:
+                    yield run
+                    run = []
+                    breaks += 1
+                run.append(Slot(child, True))
+                if child.tail:
+                    run.append(Text(child.tail))
+
+        if not self.isFiltered(root):
+            yield from walk(root)
+            yield run
+
+    def unchanged(self, slot: Slot, entries: list) -> bool:
+        text = getSlot(slot.element, slot.tail)
+        if not entries:
+            return not text
+        return len(entries) == 1 and type(entries[0]) is Text and entries[0].text == text
+
+    def spacingRoot(self, root: etree.ElementBase) -> None:
+        # the runs are all read before the tree is changed
+        for run in list(self.runs(root)):
+            if not any(type(entry) is Text for entry in run):
+                continue
+            entries = spacingRun(run, self.memo, self.compact)
+            slot = None
+            slotEntries = []
+            for entry in entries + [None]:
+                if entry is None or type(entry) is Slot:
+                    if slot is not None and not self.unchanged(slot, slotEntries):
+                        text, children = buildSlot(self.makeelement, slotEntries)
+                        insertSlot(slot.element, slot.tail, text, children)
+                    slot = entry
+                    slotEntries = []
+                else:
+                    slotEntries.append(entry)
+
+    def spacing(self) -> str:
+        roots = self.rootSelector(self.tree)
+        rootSet = set(roots)
+        roots = [root for root in roots if not any(parent in rootSet for parent in root.iterancestors())]
+        for root in roots:
+            if self.isFiltered(root):
+                continue
+            self.collapse(root)
+            protected = []
+            self.protect(root, protected)
+            self.spacingRoot(root)
+            self.restore(root, protected)
+        html = etree.tostring(self.tree if self.doctype else self.tree.getroot(), encoding="unicode", method="html")
+        return html + self.trailing
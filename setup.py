@@ -1,4 +1,5 @@
 import os
+import re
 from setuptools import setup, find_packages
 
 
@@ -9,9 +10,16 @@ def read(fname):
     return content if content else 'no content read'
 
 
+def read_version():
+    # the version is only written in mkdocs_heti_plugin/__init__.py, the
+    # package cannot be imported before its dependencies are installed
+    content = read(os.path.join('mkdocs_heti_plugin', '__init__.py'))
+    return re.search(r"^__version__ = ['\"]([^'\"]+)['\"]", content, re.M).group(1)
+
+
 setup(
     name='mkdocs-heti-plugin',
-    version='0.1.6',
+    version=read_version(),
     author='TonyCrane',
     author_email='me@tonycrane.cc',
     description='A MkDocs plugin that uses heti to improve Chinese typesetting',
@@ -25,6 +33,7 @@ setup(
         'mkdocs',
         'lxml',
         'bs4',
+        'cssselect',
     ],
     classifiers=[
         'Development Status :: 3 - Alpha',